@@ -47,96 +47,77 @@ import getopt
 import sys
 import string
 import operator
+import re
 from time import strftime, gmtime
 
 def indent(str, dent = 0, prestr = ' '):
     '''Simple function to uniformly indent lines.'''
-    return '\n'.join(map(lambda x: (prestr * dent) + x, str.split('\n')))
+    pad = prestr * dent
+    return '\n'.join([pad + x for x in str.split('\n')])
 
 def dedent(str, dent = 0):
     """Simple function to uniformly remove whitespace from the front of
        lines."""
     lines = str.split('\n')
-    try: 
-        dent = reduce(min, map(lambda x: len(x) - len(x.lstrip()), 
-          filter(lambda x: len(x.lstrip()) > 0, lines)))
-    except TypeError:
+    dents = [len(x) - len(x.lstrip()) for x in lines if x.lstrip()]
+    if (dents):
+        dent = min(dents)
+    else:
         dent = 0
-    return '\n'.join(map(lambda x: len(x.lstrip()) > 0 and x[dent:] or x, lines))
+    return '\n'.join([x[dent:] if x.lstrip() else x for x in lines])
+
+# c operator characters (not including semi-colon)
+_OP_CHARS = frozenset('-+,=()?:*/~!^|&[]{}%<>')
+
+# words that can make up the type part of a declaration
+_DECL_WORDS = frozenset(('float', 'double', 'long', 'unsigned', 'signed', 
+  'const', 'volatile', 'int', 'short', 'char', 'register', 'void', 'union', 
+  'struct', '*', '**', '***', '****'))
+
+# assignment operators that can start an assignment statement
+_ASSIGN_OPS = frozenset(('=', '+=', '-=', '/=', '*=', '&=', '|=', '^='))
 
 def isop(char):
     """Simple function to determine whether a character is a c 
        operator character (not including semi-colon)."""
-    if ((char == '-') or (char == '+') or (char == ',') or (char == '=') 
-      or (char == '(') or (char == ')') or (char == '?') or (char == ':') 
-      or (char == '*') or (char == '/') or (char == '~') or (char == '!') 
-      or (char == '^') or (char == '|') or (char == '&') or (char == '[') 
-      or (char == ']') or (char == '{') or (char == '}') or (char == '%')
-      or (char == '<') or (char == '>')):
-        return 1
-    else:
-        return 0
+    return char in _OP_CHARS
 
 def isdecl(word):
-    if (word == 'float' or word == 'double' or word == 'long' 
-      or word == 'unsigned' or word == 'signed' or word == 'const' 
-      or word == 'volatile' or word == 'int' or word == 'short' 
-      or word == 'char' or word == 'register' or word == 'void' 
-      or word == 'union' or word == 'struct' or word == '*' 
-      or word == '**' or word == '***' or word == '****'):
-        return 1
-    else:
-        return 0
+    return word in _DECL_WORDS
+
+# tokens are runs of whitespace, runs of operator characters, a lone
+# semi-colon, or runs of anything else.  The number of the group that 
+# matched classifies the token.
+_TOK_RE = re.compile(r'(\s+)|([-+,=()?:*/~!^|&\[\]{}%<>]+)|(;)'
+  r'|([^\s\-+,=()?:*/~!^|&\[\]{}%<>;]+)')
+_TOK_SPACE = 1
 
 # function to filter whitespace tokens from ctok
 def ctok_nspace(line):
-    toks, chars = ctok(line)
-
-    filtered = filter(lambda x: not x[0].isspace(), zip(toks, chars))
-
-    toks = map(lambda x: x[0], filtered)
-    chars = map(lambda x: x[1], filtered)
-
-    return toks, chars
+    matches = [m for m in _TOK_RE.finditer(line) if m.lastindex != _TOK_SPACE]
+    return [m.group(0) for m in matches], [m.start() for m in matches]
+
+# characters that can't appear within an identifier token (see _TOK_RE)
+_TOK_DELIM = r'\s\-+,=()?:*/~!^|&\[\]{}%<>;'
+
+def macro_re(macros):
+    """Returns a compiled regex matching any whole token that is a key of
+       macros, or None if there are no macros."""
+    if (not macros):
+        return None
+    return re.compile(r'(?<![^%s])(%s)(?![^%s])' % (_TOK_DELIM, 
+      '|'.join(map(re.escape, macros)), _TOK_DELIM))
+
+def replace_macros(pat, line, macros):
+    """Replaces every token in line that is a key of macros with its value,
+       using the regex returned by macro_re."""
+    if (pat is None):
+        return line
+    return pat.sub(lambda m: macros[m.group(1)], line)
 
 def ctok(line):
-    toks = []
-    chars = []
-    char = 0
-    while (len(line)):
-        c = line[0]
-        schar = char
-        line = line[1:]
-        if (c.isspace()):
-            tok = c
-            while (len(line) and line[0].isspace()):
-                tok = tok + line[0]
-                line = line[1:]
-                char += 1
-            toks.append(tok)
-            chars.append(schar)
-        elif (isop(c) == 1):
-            tok = c
-            while (len(line) and isop(line[0])):
-                tok = tok + line[0]
-                line = line[1:]
-                char += 1
-            toks.append(tok)
-            chars.append(schar)
-        elif (c == ';'):
-            toks.append(';')
-            chars.append(schar)
-        else:
-            tok = c
-            while (len(line) and isop(line[0]) == 0 
-              and line[0] != ';' and not line[0].isspace()):
-                tok = tok + line[0]
-                line = line[1:]
-                char += 1
-            toks.append(tok)
-            chars.append(schar)
-        char += 1
-    return toks, chars
+    matches = list(_TOK_RE.finditer(line))
+    return [m.group(0) for m in matches], [m.start() for m in matches]
 
 def usage(progname, decode = None, post = None):
     print 'usage: %s [--debug] metricfile templatefile' \
@@ -186,13 +167,18 @@ class Decl:
           % (self.type, self.name, self.init, self.fninit, self.level, self.lineno, self.macro, self.comment, self.pre)
 
 def ins_decl(namespaces, used, line, level, macro = '', 
-  lineno = -1, fninit = '', pre = '', contrib = '', ex = ''):
+  lineno = -1, fninit = '', pre = '', contrib = '', ex = '', 
+  pre_toks = None, pre_chars = None):
+    # pre_toks and pre_chars are the output of ctok_nspace(line), if the 
+    # caller has already tokenised it
+
     # check for and remove trailing comment
     comment = ''
     pos = line.find('#')
     if (pos > 0):
         comment = line[pos + 1:]
         line = line[0:pos]
+        pre_toks = None
     pos = line.find('/*')
     if (pos > 0):
         pos2 = line.find('*/')
@@ -200,32 +186,39 @@ def ins_decl(namespaces, used, line, level, macro = '',
             pos2 += 2
             comment = line[pos + 2:pos2 - 2]
             line = line[0:pos] + line[pos2:]
+            pre_toks = None
         else:
             print '#line', lineno, '"' + args[0] + '"'
             print '#error "multiline comment in declaration"'
 
-    toks, chars = ctok_nspace(line.rstrip())
+    if (pre_toks is not None):
+        toks, chars = pre_toks, pre_chars
+    else:
+        toks, chars = ctok_nspace(line.rstrip())
 
     type = ''
-    while (len(toks) > 0 and isdecl(toks[0]) == 1):
+    i = 0
+    while (i < len(toks) and isdecl(toks[i])):
         # this token is part of the type
 
         # skip tag in struct and union
-        if (toks[0] == 'struct' or toks[0] == 'union'):
-            type += toks[0] + ' '
-            toks = toks[1:]
+        if (toks[i] == 'struct' or toks[i] == 'union'):
+            type += toks[i] + ' '
+            i += 1
 
-        type += toks[0] + ' '
-        toks = toks[1:]
+        type += toks[i] + ' '
+        i += 1
+    toks = toks[i:]
 
     if (len(toks)):
+        name = toks[0]
+
         # check for namespace collisions
-        for n in namespaces:
-            if (n.has_key(toks[0])):
-                # collision
-                print '#line', lineno, '"' + args[0] + '"'
-                print '#error "duplicate','declaration \'', line.rstrip(), '\'"'
-                sys.exit(2)
+        if (any(name in n for n in namespaces)):
+            # collision
+            print '#line', lineno, '"' + args[0] + '"'
+            print '#error "duplicate','declaration \'', line.rstrip(), '\'"'
+            sys.exit(2)
 
         # check for and remove semi-colon
         if (toks[-1] == ';'):
@@ -242,19 +235,17 @@ def ins_decl(namespaces, used, line, level, macro = '',
 
         # identify quantities used
         for t in toks[1:]:
-            for n in namespaces:
-                if (t in n):
-                    for u in used:
-                        u[t] = t
+            if (any(t in n for n in namespaces)):
+                for u in used:
+                    u[t] = t
 
         # accept declaration
         for n in namespaces:
-            n[toks[0]] = Decl(lineno, toks[0], type.strip(), 
+            n[name] = Decl(lineno, name, type.strip(), 
               init.strip(), level, macro, comment, fninit, pre, contrib, ex)
 
         # identify quantities used in contrib (XXX: we only insert
         # them in the first namespace/used combo - this is dodgy) 
-        name = toks[0]
         toks, chars = ctok_nspace(contrib)
         for t in toks:
             if (t in namespaces[0]):
@@ -266,27 +257,37 @@ def ins_decl(namespaces, used, line, level, macro = '',
           line.rstrip(), '\'"'
         sys.exit(2)
  
-def process_decl(file, decl, decl_used, lineno):
+def getline(lines, lineno):
+    """Returns line lineno (counting from 1) from the list of lines, or ''
+       if there is no such line, in the manner of file.readline()."""
+    if (lineno <= len(lines)):
+        return lines[lineno - 1]
+    else:
+        return ''
+
+def process_decl(lines, decl, decl_used, lineno):
     """Function to process declarations in post, decode sections.  
        Returns first line that isn't a declaration."""
 
     # start with next line
-    line = file.readline()
     lineno += 1
+    line = getline(lines, lineno)
 
     while (line != '' and line.rstrip() != '}'):
         # in decl section
-        if (len(line.strip()) > 0 and line.strip()[0] != '#'):
+        sline = line.strip()
+        if (len(sline) > 0 and sline[0] != '#'):
             toks, chars = ctok_nspace(line)
             # tokenise line and process it
-            if (isdecl(toks[0]) == 1):
-                ins_decl([decl], [decl_used], line=line, level=1, macro='', lineno=lineno, contrib='', ex='user declared quantity')
+            if (isdecl(toks[0])):
+                ins_decl([decl], [decl_used], line=line, level=1, macro='', lineno=lineno, contrib='', ex='user declared quantity',
+                  pre_toks=toks, pre_chars=chars)
             else:
                 return [lineno, line]
 
         # next line
-        line = file.readline()
         lineno += 1
+        line = getline(lines, lineno)
 
     if (line == ''):
         print '#line', lineno, '"' + args[0] + '"'
@@ -295,27 +296,38 @@ def process_decl(file, decl, decl_used, lineno):
 
     return [lineno, line]
 
-def levelise(file, line, lineno, decl, list, used):
+def statement(lineno, level, text):
+    """Returns a statement record: line number, logical level, text, and 
+       whether the text contains an opening and/or closing brace."""
+    return [lineno, level, text, '{' in text, '}' in text]
+
+def levelise(lines, line, lineno, decl, list, used):
     """assign lines in a file to a list, annotating them with logical levels."""
 
     # declarations processed, now for statements
     while (line != '' and line.rstrip() != '}'):
+        sline = line.strip()
+        if (sline.startswith('#')):
+            # comment, no need to tokenise it
+            list.append(statement(lineno, 1, 
+              '/* ' + sline[1:].lstrip() + ' */'))
+            lineno += 1
+            line = getline(lines, lineno)
+            continue
+
         # process statements 
         toks, chars = ctok_nspace(line)
  
         if (len(toks) > 2 
-          and (toks[0] in decl.keys())
-          and (toks[1] == '=' or toks[1] == '+='
-            or toks[1] == '-=' or toks[1] == '/='
-            or toks[1] == '*=' or toks[1] == '&='
-            or toks[1] == '|=' or toks[1] == '^=')):
+          and (toks[0] in decl)
+          and (toks[1] in _ASSIGN_OPS)):
 
             # assignment statement
 
             # extend logical 'line' and tokenise it
             while (toks[-1] != ';'):
-                nline = file.readline()
                 lineno += 1
+                nline = getline(lines, lineno)
                 ntoks, nchars = ctok_nspace(nline)
                 toks.extend(ntoks)
                 line = line.rstrip() + ' ' + nline
@@ -333,7 +345,7 @@ def levelise(file, line, lineno, decl, list, used):
             used[toks[0]] = toks[0]
 
             for t in toks[2:]:
-                if (t in decl.keys()):
+                if (t in decl):
                     used[t] = t
                     if (decl[t].level == 6):
                         print '#line', lineno, '"' + args[0] + '"'
@@ -343,17 +355,15 @@ def levelise(file, line, lineno, decl, list, used):
 
             # increase level of assigned quantity, providing basic level
             # inference 
-            if (toks[0] in decl.keys()):
+            if (toks[0] in decl):
                 decl[toks[0]].level = level
 
-            list.append([lineno, level, line.strip()])
-        elif (len(toks) and line.strip()[0] == '#'):
-            list.append([lineno, 1, '/* ' + line.strip()[1:].lstrip() + ' */'])
+            list.append(statement(lineno, level, line.strip()))
         else:
             # its a different type of statement, check level differently 
             level = 1
             for t in toks:
-                if (t in decl.keys()):
+                if (t in decl):
                     used[t] = t
                     if (decl[t].level == 6):
                         print '#line', lineno, '"' + args[0] + '"'
@@ -361,11 +371,11 @@ def levelise(file, line, lineno, decl, list, used):
                     elif (decl[t].level > level):
                         level = decl[t].level
 
-            list.append([lineno, level, line.strip()])
+            list.append(statement(lineno, level, line.strip()))
 
         # next line
-        line = file.readline()
         lineno += 1
+        line = getline(lines, lineno)
 
     return [lineno, line]
 
@@ -375,27 +385,24 @@ def propagate(statements):
     # FIXME: needs to handle multiline blocks properly
     prevlevel = 0
     for s in statements:
-        if (s[2].find('}') >= 0):
-            if (s[2].find('{') < 0):
-                if (prevlevel > s[1]):
-                    s[1] = prevlevel
+        if (s[4] and not s[3]):
+            if (prevlevel > s[1]):
+                s[1] = prevlevel
         prevlevel = s[1]
 
-    rev = map(lambda x: x, statements)
-    rev.reverse
-
     prevlevel = 0
-    for s in rev:
-        if (s[2].find('{') >= 0):
-            if (s[2].find('}') < 0):
-                if (prevlevel > s[1]):
-                    s[1] = prevlevel
+    for s in reversed(statements):
+        if (s[3] and not s[4]):
+            if (prevlevel > s[1]):
+                s[1] = prevlevel
         prevlevel = s[1]
 
-def output_decl(definitions, dent, mfile, params, macros):
+def output_decl(out, definitions, dent, mfile, params, macros):
+    """Appends declarations for definitions to the list out."""
     prevline = -1
+    pat = macro_re(macros)
 
-    definitions.sort(lambda x, y: x.lineno - y.lineno)
+    definitions.sort(key=lambda x: x.lineno)
 
     for d in definitions:
         # check that it isn't a pre-defined quantity that we've
@@ -417,29 +424,25 @@ def output_decl(definitions, dent, mfile, params, macros):
                 if (len(d.init)):
                     str += ' '
                     # output the line, replacing parameters
-                    toks, spaces = ctok(d.init)
-                    for t in toks:
-                        if (t in macros):
-                            str += macros[t]
-                        else:
-                            str += t
-                    print
+                    str += replace_macros(pat, d.init, macros)
+                    out.append('\n')
 
                 str += ';'
-                print str
+                out.append(str + '\n')
 
     num = 0
     for d in definitions:
         # check that it isn't a pre-defined quantity that we've
         # already declared
         if (len(d.fninit) > 0):
-            print indent(dedent(d.fninit), len(dent))
+            out.append(indent(dedent(d.fninit), len(dent)) + '\n')
 
-def print_level(statements, level, dent, name, macros):
+def print_level(out, statements, level, dent, name, macros):
+    """Appends statements at the given level to the list out."""
     # output statements that depend on level
     prevline = -1
-    while (len(statements)):
-        l, statements = statements[0], statements[1:]
+    pat = macro_re(macros)
+    for l in statements:
         if (l[1] == level):
 
             # check if we have to output a #line directive
@@ -450,30 +453,23 @@ def print_level(statements, level, dent, name, macros):
 
             # check if we need to decrease the dent (has to be before
             # output for ending } brackets to be indented properly)
-            if (l[2].find('}') >= 0):
-                if (l[2].find('{') < 0):
-                    dent -= 4
+            if (l[4] and not l[3]):
+                dent -= 4
 
             # output the line, replacing parameters
-            toks, spaces = ctok(l[2])
-            sys.stdout.write(' ' * dent)
-            for t in toks:
-                if (t in macros):
-                    sys.stdout.write(macros[t])
-                else:
-                    sys.stdout.write(t)
-            print
+            out.append(' ' * dent + replace_macros(pat, l[2], macros) + '\n')
 
             # check if we need to increase the dent
-            if (l[2].find('{') >= 0):
-                if (l[2].find('}') < 0):
-                    dent += 4
+            if (l[3] and not l[4]):
+                dent += 4
 
-# get the next non-whitespace token, or nothing if there isn't one
-def next_tok(toks):
-    while (len(toks) and toks[0].isspace() == True):
-        toks = toks[1:]
-    return toks
+# get the index of the next non-whitespace token at or after i in the 
+# output of ctok, or len(toks) if there isn't one.  ctok returns each run
+# of whitespace as a single token, so there is at most one to skip.
+def next_tok(toks, i = 0):
+    if (i < len(toks) and toks[i].isspace()):
+        i += 1
+    return i
 
 def contrib_replace(x):
     if (len(x.contrib)):
@@ -487,6 +483,95 @@ def get_replace_map(decls, fn = (lambda x: x.macro)):
         map[i] = '(' + fn(decls[i]) + ')'
     return map
 
+# pre-declared quantities, as (declaration, level, other ins_decl 
+# arguments).  levels are:
+#   - 0: undetermined
+#   - 1: depends on nothing
+#   - 2: depends on docno
+#   - 3: depends on f_dt
+#   - 4: depends on offset
+#   - 5: depends on attr
+
+# declarations for inherent quantities, only available in decode (these 
+# are not output directly) 
+_DECODE_BUILTINS = [
+    ('const unsigned int f_t;', 1, {'macro': 'query->term[qterm].f_t', 
+      'ex': 'number of documents in collection term occurs in'}),
+    ('const unsigned int F_t;', 1, {'macro': 'query->term[qterm].F_t',
+      'ex': 'number of times term occurs in collection'}),
+    ('const unsigned int f_dt;', 3, 
+      {'ex': 'number of times term occurs in current document'}),
+    #('const unsigned int offset;', 4, {}),
+    #('const unsigned int attr;', 5, {}),
+]
+
+# quantities available in both decode and post
+_BUILTINS = [
+    ('float accumulator;', 2, {'macro': 'acc->acc.weight',
+      'ex': 'accumulated score of document'}),
+    ('const unsigned int dterms = iobtree_size(idx->vocab);', 1,
+      {'ex': 'number of distinct terms in the collection'}),
+    ('const double terms = ((double) UINT_MAX) * idx->stats.terms_high + idx->stats.terms_low;', 1,
+      {'ex': 'number of terms in the collection'}),
+    ('const unsigned int N = docmap_entries(idx->map);', 1,
+      {'ex': 'number of documents in the collection'}),
+    ('double avg_D_bytes;', 1, {'fninit': '''\
+         if (docmap_avg_bytes(idx->map, &avg_D_bytes) != DOCMAP_OK) {
+             return SEARCH_EINVAL;
+         }''',
+      'ex': 'average bytes per document in the collection'}),
+    ('double avg_D_terms;', 1, {'fninit': '''\
+         if (docmap_avg_words(idx->map, &avg_D_terms) != DOCMAP_OK) {
+             return SEARCH_EINVAL;
+         }''',
+      'ex': 'average terms per document in the collection'}),
+    ('double avg_D_dterms;', 1, {'fninit': '''\
+         if (docmap_avg_distinct_words(idx->map, &avg_D_dterms) != DOCMAP_OK) {
+             return SEARCH_EINVAL;
+         }''',
+      'ex': 'average distinct terms per document in the collection'}),
+    ('double avg_D_weight;', 1, {'fninit': 
+      '''if (docmap_avg_weight(idx->map, &avg_D_weight) != DOCMAP_OK) {
+             return SEARCH_EINVAL;
+         }''',
+      'ex': 'average cosine weight per document in the collection'}),
+    #('const unsigned int Q_bytes;', 1, {'macro': 'qstat->bytes',
+    #  'ex': 'number of bytes in the query string'}),
+    ('const unsigned int Q_terms = search_qterms(query);', 1,
+      {'ex': 'number of terms in the query'}),
+    ('const unsigned int Q_dterms;', 1, {'macro': 'query->terms',
+      'ex': 'number of distinct terms in the query'}),
+    ('const float Q_weight = search_qweight(query);', 1,
+      {'ex': 'cosine weight of query'}),
+    ('const unsigned int D_bytes;', 2, 
+      {'macro': 'docmap_get_bytes_cached(idx->map, acc->acc.docno)', 
+      'pre': 'if (docmap_cache(idx->map, docmap_get_cache(idx->map) | DOCMAP_CACHE_BYTES) != DOCMAP_OK) return SEARCH_EINVAL;', 
+      'contrib': '((float) avg_D_bytes)',
+      'ex': 'number of bytes in the current document'}),
+    ('const unsigned int D_terms;', 2, 
+      {'macro': 'DOCMAP_GET_WORDS(idx->map, acc->acc.docno)',
+      'pre': 'if (docmap_cache(idx->map, docmap_get_cache(idx->map) | DOCMAP_CACHE_WORDS) != DOCMAP_OK) return SEARCH_EINVAL;', 
+      'contrib': '((float) avg_D_terms)',
+      'ex': 'number of terms in the current document'}),
+    ('const unsigned int D_dterms;', 2, 
+      {'macro': 'DOCMAP_GET_DISTINCT_WORDS(idx->map, acc->acc.docno)',
+      'pre': 'if (docmap_cache(idx->map, docmap_get_cache(idx->map) | DOCMAP_CACHE_DISTINCT_WORDS) != DOCMAP_OK) return SEARCH_EINVAL;', 
+      'contrib': '((float) avg_D_dterms)',
+      'ex': 'number of distinct terms in the current document'}),
+    ('const float D_weight;', 2, 
+      {'macro': 'DOCMAP_GET_WEIGHT(idx->map, acc->acc.docno)',
+      'pre': 'if (docmap_cache(idx->map, docmap_get_cache(idx->map) | DOCMAP_CACHE_WEIGHT) != DOCMAP_OK) return SEARCH_EINVAL;', 
+      'contrib': '((float) avg_D_weight)',
+      'ex': 'cosine weight of the current document'}),
+    ('const unsigned int f_qt;', 1, {'macro': 'query->term[qterm].f_qt',
+      'ex': 'number of times the current term occurred in the query'}),
+]
+
+def pre_infer(used, decl):
+    """Returns the pre code for each used declaration that has some, in 
+       declaration order."""
+    return [decl[x].pre for x in decl if x in used and decl[x].pre]
+
 if __name__ == "__main__":
     try:
         (options, args) = getopt.getopt(sys.argv[1:], 'hv', 
@@ -522,95 +607,12 @@ if __name__ == "__main__":
     comments = []    # initial comments
     decode_used = {} # quantities used in decode
 
-    # define pre-declared quantities in all three function namespaces
-    #
-    # levels are:
-    #   - 0: undetermined
-    #   - 1: depends on nothing
-    #   - 2: depends on docno
-    #   - 3: depends on f_dt
-    #   - 4: depends on offset
-    #   - 5: depends on attr
-
-    # declarations for inherent quantities (these are not output directly) 
-    ins_decl([decode_decl], [decode_used], 'const unsigned int f_t;', 1, 'query->term[qterm].f_t', 
-      ex='number of documents in collection term occurs in')
-    ins_decl([decode_decl], [decode_used], 'const unsigned int F_t;', 1, 'query->term[qterm].F_t',
-      ex='number of times term occurs in collection')
-    ins_decl([decode_decl], [decode_used], 'const unsigned int f_dt;', 3,
-      ex='number of times term occurs in current document')
-    #ins_decl([decode_decl], [decode_used], 'const unsigned int offset;', 4)
-    #ins_decl([decode_decl], [decode_used], 'const unsigned int attr;', 5)
-
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'float accumulator;', 2, 'acc->acc.weight',
-      ex='accumulated score of document')
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'const unsigned int dterms = iobtree_size(idx->vocab);', 1,
-      ex='number of distinct terms in the collection')
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'const double terms = ((double) UINT_MAX) * idx->stats.terms_high + idx->stats.terms_low;', 1,
-      ex='number of terms in the collection')
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'const unsigned int N = docmap_entries(idx->map);', 1,
-      ex='number of documents in the collection')
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'double avg_D_bytes;', 1, '', -1, 
-      '''\
-         if (docmap_avg_bytes(idx->map, &avg_D_bytes) != DOCMAP_OK) {
-             return SEARCH_EINVAL;
-         }''',
-      ex='average bytes per document in the collection')
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'double avg_D_terms;', 1, '', -1,
-      '''\
-         if (docmap_avg_words(idx->map, &avg_D_terms) != DOCMAP_OK) {
-             return SEARCH_EINVAL;
-         }''',
-      ex='average terms per document in the collection')
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'double avg_D_dterms;', 1, '', -1,
-      '''\
-         if (docmap_avg_distinct_words(idx->map, &avg_D_dterms) != DOCMAP_OK) {
-             return SEARCH_EINVAL;
-         }''',
-      ex='average distinct terms per document in the collection')
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'double avg_D_weight;', 1, '', -1,
-      '''if (docmap_avg_weight(idx->map, &avg_D_weight) != DOCMAP_OK) {
-             return SEARCH_EINVAL;
-         }''',
-      ex='average cosine weight per document in the collection')
-    # ins_decl([decode_decl, post_decl], None, 'const unsigned int Q_bytes;', 1, 'qstat->bytes',
-    #  ex='number of bytes in the query string')
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'const unsigned int Q_terms = search_qterms(query);', 1,
-      ex='number of terms in the query')
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'const unsigned int Q_dterms;', 1, 'query->terms',
-      ex='number of distinct terms in the query')
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'const float Q_weight = search_qweight(query);', 1,
-      ex='cosine weight of query')
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'const unsigned int D_bytes;', 2, 'docmap_get_bytes_cached(idx->map, acc->acc.docno)', -1, '', 
-      'if (docmap_cache(idx->map, docmap_get_cache(idx->map) | DOCMAP_CACHE_BYTES) != DOCMAP_OK) return SEARCH_EINVAL;', '((float) avg_D_bytes)',
-      ex='number of bytes in the current document')
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'const unsigned int D_terms;', 2, 'DOCMAP_GET_WORDS(idx->map, acc->acc.docno)', -1, '',
-      'if (docmap_cache(idx->map, docmap_get_cache(idx->map) | DOCMAP_CACHE_WORDS) != DOCMAP_OK) return SEARCH_EINVAL;', '((float) avg_D_terms)',
-      ex='number of terms in the current document')
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'const unsigned int D_dterms;', 2, 'DOCMAP_GET_DISTINCT_WORDS(idx->map, acc->acc.docno)', -1, '',
-      'if (docmap_cache(idx->map, docmap_get_cache(idx->map) | DOCMAP_CACHE_DISTINCT_WORDS) != DOCMAP_OK) return SEARCH_EINVAL;', '((float) avg_D_dterms)',
-      ex='number of distinct terms in the current document')
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'const float D_weight;', 2, 'DOCMAP_GET_WEIGHT(idx->map, acc->acc.docno)', -1, '',
-      'if (docmap_cache(idx->map, docmap_get_cache(idx->map) | DOCMAP_CACHE_WEIGHT) != DOCMAP_OK) return SEARCH_EINVAL;', '((float) avg_D_weight)',
-      ex='cosine weight of the current document')
-    ins_decl([decode_decl, post_decl], [decode_used, post_used], 
-      'const unsigned int f_qt;', 1, 'query->term[qterm].f_qt',
-      ex='number of times the current term occurred in the query')
+    # define pre-declared quantities (see _DECODE_BUILTINS and _BUILTINS)
+    for line, level, kw in _DECODE_BUILTINS:
+        ins_decl([decode_decl], [decode_used], line, level, **kw)
+    for line, level, kw in _BUILTINS:
+        ins_decl([decode_decl, post_decl], [decode_used, post_used], 
+          line, level, **kw)
 
     if (help):
         usage(sys.argv[0], decode_decl, post_decl)
@@ -625,79 +627,80 @@ if __name__ == "__main__":
 
     try:
         file = open(args[0])
-
-        lineno = 1
-        line = file.readline()
-        while (line != ''):
-            sline = line.strip()
-            words = line.split()
-
-            if (len(sline) == 0 or sline[0] == '#'):
-                # its a or empty comment, do nothing
-                if (lineno <= len(comments) + 1):
-                    # preserve initial comments for insertion into
-                    # final file
-                    if (len(sline) > 0):
-                        comments.append(line.strip()[1:].lstrip())
-                    else:
-                        comments.append('')
-            elif (len(words) > 1 and words[0] == 'parameter'):
-                # got parameter, process it (MUST be one line)
-
-                vname = words[1:]
-                while (isdecl(vname[0]) == 1):
-                    vname = vname[1:]
-                vname = vname[0].strip()
-                if (vname[-1] == ';'):
-                    vname = vname[0:-1]
-
-                ins_decl([params, post_decl, decode_decl], 
-                  [decode_used, post_used], line[len('parameter'):], 
-                  level=1, lineno=lineno, 
-                  macro='opt->u.' + name + '.' + vname)
-
-            elif (len(words) == 2 and words[0] == 'post()' 
-              and words[1] == '{'):
-                # in post section
-
-                [lineno, line] = process_decl(file, post_decl, post_used, lineno)
-
-                [lineno, line] = levelise(file, line, lineno, post_decl, 
-                  post, post_used)
-
-                if (line == ''):
-                    print '#line', lineno, '"' + args[0] + '"'
-                    print '#error "unexpected EOF in post"'
-                    sys.exit(2)
-
-            elif (len(words) == 2 and words[0] == 'decode()' 
-              and words[1] == '{'):
-                # in decode section
-
-                [lineno, line] = process_decl(file, decode_decl, decode_used, lineno)
-
-                [lineno, line] = levelise(file, line, lineno, decode_decl, 
-                  decode, decode_used)
-
-                if (line == ''):
-                    print '#line', lineno, '"' + args[0] + '"'
-                    print '#error "unexpected EOF in decode"'
-                    sys.exit(2)
-
-            else:
-                print '#line', lineno, '"' + args[0] + '"'
-                print '#error "unexpected line:', line.rstrip(), '"'
-                sys.exit(2)
-       
-            # next line
-            line = file.readline()
-            lineno += 1
+        lines = file.readlines()
         file.close()
     except IOError:
         # error reading from file
         print 'error opening file', args[0]
         sys.exit(2)
 
+    lineno = 1
+    line = getline(lines, lineno)
+    while (line != ''):
+        sline = line.strip()
+        words = line.split()
+
+        if (len(sline) == 0 or sline[0] == '#'):
+            # its a or empty comment, do nothing
+            if (lineno <= len(comments) + 1):
+                # preserve initial comments for insertion into
+                # final file
+                if (len(sline) > 0):
+                    comments.append(line.strip()[1:].lstrip())
+                else:
+                    comments.append('')
+        elif (len(words) > 1 and words[0] == 'parameter'):
+            # got parameter, process it (MUST be one line)
+
+            vname = words[1:]
+            while (isdecl(vname[0])):
+                vname = vname[1:]
+            vname = vname[0].strip()
+            if (vname[-1] == ';'):
+                vname = vname[0:-1]
+
+            ins_decl([params, post_decl, decode_decl], 
+              [decode_used, post_used], line[len('parameter'):], 
+              level=1, lineno=lineno, 
+              macro='opt->u.' + name + '.' + vname)
+
+        elif (len(words) == 2 and words[0] == 'post()' 
+          and words[1] == '{'):
+            # in post section
+
+            [lineno, line] = process_decl(lines, post_decl, post_used, lineno)
+
+            [lineno, line] = levelise(lines, line, lineno, post_decl, 
+              post, post_used)
+
+            if (line == ''):
+                print '#line', lineno, '"' + args[0] + '"'
+                print '#error "unexpected EOF in post"'
+                sys.exit(2)
+
+        elif (len(words) == 2 and words[0] == 'decode()' 
+          and words[1] == '{'):
+            # in decode section
+
+            [lineno, line] = process_decl(lines, decode_decl, decode_used, lineno)
+
+            [lineno, line] = levelise(lines, line, lineno, decode_decl, 
+              decode, decode_used)
+
+            if (line == ''):
+                print '#line', lineno, '"' + args[0] + '"'
+                print '#error "unexpected EOF in decode"'
+                sys.exit(2)
+
+        else:
+            print '#line', lineno, '"' + args[0] + '"'
+            print '#error "unexpected line:', line.rstrip(), '"'
+            sys.exit(2)
+   
+        # next line
+        lineno += 1
+        line = getline(lines, lineno)
+
     # remove empty lines from the end of comments
     while (len(comments) > 0 and comments[-1] == ''):
         comments = comments[0:-1]
@@ -707,7 +710,6 @@ if __name__ == "__main__":
     propagate(decode)
 
     # infer what goes into pre
-    pre_infer = lambda used, decl: map(lambda x: decl[x].pre, filter(lambda x: x in used and len(decl[x].pre) > 0, decl))
     pre = pre_infer(post_used, post_decl)
     pre.extend(pre_infer(decode_used, decode_decl))
 
@@ -740,6 +742,10 @@ if __name__ == "__main__":
         try:
             template = open(args[1])
 
+            # output is accumulated in out and written a section at a time
+            out = []
+            emit = out.append
+
             # insert our comment
             str = '''\
               /* %s.c implements the %s metric for the zettair query
@@ -755,25 +761,98 @@ if __name__ == "__main__":
                * Comments from %s.metric:
                *'''
  
-            print (dedent(str) % (name.lower(), name, args[0], args[1], 
+            emit(dedent(str) % (name.lower(), name, args[0], args[1], 
               sys.argv[0], strftime("%a, %d %b %Y %H:%M:%S GMT", gmtime()), 
-              args[0], args[1], name))
+              args[0], args[1], name) + '\n')
 
             for l in comments:
-                print ' *', l
+                emit(' * ' + l + '\n')
 
             if (len(comments) > 0):
-                print ' *'
-
-            print ' */'
-            print 
+                emit(' *\n')
+
+            emit(' */\n')
+            emit('\n')
+            sys.stdout.write(''.join(out))
+            del out[:]
+
+            # macro replacements used by the expansions below, which don't 
+            # change while the template is processed
+            post_map = get_replace_map(post_decl)
+            decode_map = get_replace_map(decode_decl)
+            contrib_map = get_replace_map(decode_decl, contrib_replace)
+
+            # expansions of the formatted comments in the template, each of
+            # which appends code to out, indented by dent
+            def metric_name(out, dent):
+                out.append('/* METRIC_NAME */ ' + name)
+
+            def metric_depends_post(out, dent):
+                out.append('/* METRIC_DEPENDS_POST */ %d' % len(post))
+
+            def metric_pre(out, dent):
+                out.append('/* METRIC_PRE */\n')
+                for l in pre:
+                    out.append(indent(l, dent) + '\n')
+                #print '#line %u "%s"' % (currline, args[1])
+
+            def metric_post(out, dent):
+                out.append('/* METRIC_POST */\n')
+                output_decl(out, map(lambda x: post_decl[x], post_used.keys()), 
+                  dent * ' ', args[0], params, post_map)
+                print_level(out, post, 1, dent, name, post_map)
+                #print '#line %u "%s"' % (currline, args[1])
+
+            def metric_post_per_doc(out, dent):
+                out.append('/* METRIC_POST_PER_DOC */\n')
+                print_level(out, post, 2, dent, name, post_map)
+                #print '#line %u "%s"' % (currline, args[1])
+
+            def metric_decl(out, dent):
+                out.append('/* METRIC_DECL */\n')
+                output_decl(out, map(lambda x: decode_decl[x], decode_used.keys()), 
+                  dent * ' ', args[0], params, decode_map)
+
+            def metric_per_call(out, dent):
+                out.append('/* METRIC_PER_CALL */\n')
+                # output level one stuff
+                print_level(out, decode, 1, dent, name, decode_map)
+                #print '#line %u "%s"' % (currline, args[1])
+
+            def metric_per_doc(out, dent):
+                out.append('/* METRIC_PER_DOC */\n')
+                # output level two and level three stuff
+                print_level(out, decode, 2, dent, name, decode_map)
+                print_level(out, decode, 3, dent, name, decode_map)
+                #print '#line %u "%s"' % (currline, args[1])
+
+            def metric_contrib(out, dent):
+                out.append('/* METRIC_CONTRIB */\n')
+                # output level two and three stuff,
+                # but using averages instead of specific
+                # doc values
+                print_level(out, decode, 2, dent, name, contrib_map)
+                print_level(out, decode, 3, dent, name, contrib_map)
+                #print '#line %u "%s"' % (currline, args[1])
+
+            expansions = {
+                'METRIC_NAME': metric_name,
+                'METRIC_DEPENDS_POST': metric_depends_post,
+                'METRIC_PRE': metric_pre,
+                'METRIC_POST': metric_post,
+                'METRIC_POST_PER_DOC': metric_post_per_doc,
+                'METRIC_DECL': metric_decl,
+                'METRIC_PER_CALL': metric_per_call,
+                'METRIC_PER_DOC': metric_per_doc,
+                'METRIC_CONTRIB': metric_contrib,
+            }
 
             # process the file, tokenising so we can process comments
             # that aren't the only thing on a line
             first = 1
-            currline = 0
-            for l in template:
-                currline += 1
+            template_lines = template.readlines()
+            template.close()
+            for currline, l in enumerate(template_lines, 1):
                 if (first):
                     if (l.find('*/') != -1):
                         # first comment over, print out line we're at in 
@@ -784,79 +863,25 @@ if __name__ == "__main__":
                     toks, chars = ctok(l)
                     dent = len(l) - len(l.lstrip()) 
 
-                    while (len(toks)):
-                        nt = next_tok(toks[1:])
-                        nnt = next_tok(nt[1:])
-                        if (toks[0] == '/*' and len(nnt) and nnt[0] == '*/' 
-                          and nt[0] == 'METRIC_NAME'):
-                            print '/* METRIC_NAME */', name,
-                            toks = nnt[1:]
-                        elif (toks[0] == '/*' and len(nnt) and nnt[0] == '*/' 
-                          and nt[0] == 'METRIC_DEPENDS_POST'):
-                            print '/* METRIC_DEPENDS_POST */', len(post),
-                            toks = nnt[1:]
-                        elif (toks[0] == '/*' and len(nnt) and nnt[0] == '*/' 
-                          and nt[0] == 'METRIC_PRE'):
-                            print '/* METRIC_PRE */'
-                            for l in pre:
-                                print indent(l, dent)
-                            #print '#line %u "%s"' % (currline, args[1])
-                            toks = nnt[1:]
-                        elif (toks[0] == '/*' and len(nnt) and nnt[0] == '*/' 
-                          and nt[0] == 'METRIC_POST'):
-                            print '/* METRIC_POST */'
-                            output_decl(map(lambda x: post_decl[x], post_used.keys()), dent * ' ', args[0], params,
-                              get_replace_map(post_decl))
-                            print_level(post, 1, dent, name, 
-                              get_replace_map(post_decl))
-                            #print '#line %u "%s"' % (currline, args[1])
-                            toks = nnt[1:]
-                        elif (toks[0] == '/*' and len(nnt) and nnt[0] == '*/' 
-                          and nt[0] == 'METRIC_POST_PER_DOC'):
-                            print '/* METRIC_POST_PER_DOC */'
-                            print_level(post, 2, dent, name, 
-                              get_replace_map(post_decl))
-                            #print '#line %u "%s"' % (currline, args[1])
-                            toks = nnt[1:]
-                        elif (toks[0] == '/*' and len(nnt) and nnt[0] == '*/' 
-                          and nt[0] == 'METRIC_DECL'):
-                            print '/* METRIC_DECL */'
-                            output_decl(map(lambda x: decode_decl[x], decode_used.keys()), dent * ' ', args[0], params,
-                              get_replace_map(decode_decl))
-                            toks = nnt[1:]
-                        elif (toks[0] == '/*' and len(nnt) and nnt[0] == '*/' 
-                          and nt[0] == 'METRIC_PER_CALL'):
-                            print '/* METRIC_PER_CALL */'
-                            # output level one stuff
-                            print_level(decode, 1, dent, name, 
-                              get_replace_map(decode_decl))
-                            #print '#line %u "%s"' % (currline, args[1])
-                            toks = nnt[1:]
-                        elif (toks[0] == '/*' and len(nnt) and nnt[0] == '*/' 
-                          and nt[0] == 'METRIC_PER_DOC'):
-                            print '/* METRIC_PER_DOC */'
-                            # output level two and level three stuff
-                            print_level(decode, 2, dent, name, 
-                              get_replace_map(decode_decl))
-                            print_level(decode, 3, dent, name,
-                              get_replace_map(decode_decl))
-                            #print '#line %u "%s"' % (currline, args[1])
-                            toks = nnt[1:]
-                        elif (toks[0] == '/*' and len(nnt) and nnt[0] == '*/' 
-                          and nt[0] == 'METRIC_CONTRIB'):
-                            print '/* METRIC_CONTRIB */'
-                            # output level two and three stuff,
-                            # but using averages instead of specific
-                            # doc values
-                            print_level(decode, 2, dent, name, 
-                              get_replace_map(decode_decl, contrib_replace))
-                            print_level(decode, 3, dent, name,
-                              get_replace_map(decode_decl, contrib_replace))
-                            #print '#line %u "%s"' % (currline, args[1])
-                            toks = nnt[1:]
-                        else:
-                            sys.stdout.write(toks[0])
-                            toks = toks[1:]
+                    i = 0
+                    ntoks = len(toks)
+                    while (i < ntoks):
+                        tok = toks[i]
+                        if (tok == '/*'):
+                            # only comments can be expansions, so only look 
+                            # ahead from the start of one
+                            nt = next_tok(toks, i + 1)
+                            nnt = next_tok(toks, nt + 1)
+                            if (nnt < ntoks and toks[nnt] == '*/' 
+                              and toks[nt] in expansions):
+                                expansions[toks[nt]](out, dent)
+                                i = nnt + 1
+                                continue
+                        emit(tok)
+                        i += 1
+
+                    sys.stdout.write(''.join(out))
+                    del out[:]
         except IOError:
             # error reading from file
             print 'error opening file', args[1]
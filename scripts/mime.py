@@ -7,53 +7,107 @@
    and the list of important MIME types at src/mime-types.txt when
    regenerating the MIME module.
 
-   FIXME: should compress trie recognition code down for recognition
-   of shared sequences (i.e. for 'application', after first 'a' there
-   is no non-error divergence until whole thing is matched)
-
    written nml 2004-06-11
 """
 
 import getopt
+import itertools
+import re
 import sys
 import string
-import operator
 from time import strftime, gmtime
 
 def dedent(str, dent = 0):
     """Simple function to uniformly remove whitespace from the front of
        lines."""
     lines = str.split('\n')
-    try: 
-        dent = reduce(min, map(lambda x: len(x) - len(x.lstrip()), 
-          filter(lambda x: len(x.lstrip()) > 0, lines)))
-    except TypeError:
+    dents = [len(x) - len(x.lstrip()) for x in lines if x.lstrip()]
+    if (dents):
+        dent = min(dents)
+    else:
         dent = 0
-    return '\n'.join(map(lambda x: len(x.lstrip()) > 0 and x[dent:] or x, lines))
+    return '\n'.join([x[dent:] if x.lstrip() else x for x in lines])
 
 def indent(str, dent):
     """Simple function to uniformly add whitespace to the front of lines."""
     return '\n'.join(map(lambda x: ' ' * dent + x, str.split('\n')))
 
+# canonical list of media types
+_MEDIA_TYPES_URL = ('http://www.isi.edu/in-notes/iana/assignments/media-types/'
+  + 'media-types')
+
+# comment at the top of the c header file
+_HEADER_COMMENT = dedent('''\
+    /* mime.h provides support for MIME types as originally proposed 
+     * by RFCs 1521 and 1522, and updated by RFCs 2045 through 2049.
+     * It provides enumerations for convenient representation of 
+     * recognised MIME types, as well as a functions for determining
+     * MIME types for given MIME names and file contents.
+     *
+     * DO NOT modify this file, as it is automatically generated 
+     * and changes will be lost upon subsequent regeneration.
+     *
+     * It is automatically generated from media-type files describing 
+     * valid MIME types by %s.  The definitive list can be found at 
+     * %s, 
+     * although %s will accept multiple files (in the same format), 
+     * allowing you to define your own MIME types as convenient.
+     *
+     * This file was generated on %s 
+     * by %s
+     *
+     */''')
+
+# comment and includes at the top of the c body file
+_BODY_PREAMBLE = dedent('''\
+    /* mime.c implements the interface declared by mime.h
+     *
+     * DO NOT modify this file, as it is automatically generated 
+     * and changes will be lost upon subsequent regeneration.
+     *
+     * It is automatically generated from media-type files describing 
+     * valid MIME types by %s.  The definitive list can be found at 
+     * %s, 
+     * although %s will accept multiple files (in the same format), 
+     * allowing you to define your own MIME types as convenient.
+     *
+     * This file was generated on %s 
+     * by %s
+     *
+     */
+
+    #include "firstinclude.h"
+
+    #include "mime.h"
+
+    #include "str.h"
+
+    #include <ctype.h>
+    #include <stdlib.h>
+''')
+
+# translation table for maptrans, which also deletes '$' characters
+_MAPTRANS_TABLE = string.maketrans('-.+', '___')
+
+# memoised results of maptrans
+_maptrans_cache = {}
+
 def maptrans(string):
     """Remove c-incompatible characters from mime types."""
-    return string.upper().replace('-', '_').replace('.', '_')\
-      .replace('$', '').replace('+', '_')
-
-def get_prefix(string_list):
-    '''Returns the common prefix between a list of strings'''
-    if (len(string_list) == 0):
-        return ''
-    elif (len(string_list) == 1):
-        return string_list[0]
-    else:
-        pre = string_list[0]
-        lpre = len(pre)
-        for s in string_list[1:]:
-            while (pre != s[0:lpre]):
-                lpre -= 1
-                pre = pre[0:lpre]
-        return pre
+    try:
+        return _maptrans_cache[string]
+    except KeyError:
+        trans = string.upper().translate(_MAPTRANS_TABLE, '$')
+        _maptrans_cache[string] = trans
+        return trans
+
+# splits a line from a media types file into its indentation and first two 
+# words
+_LINE_RE = re.compile(r'(\s*)(\S+)(?:\s+(\S+))?')
+
+# known top-level types, which mark the start of the types section
+_TOPTYPES = frozenset(['text', 'multipart', 'message', 'chemical', 
+  'application', 'image', 'audio', 'video', 'model', 'inode'])
 
 class TopType:
     """Class to represent a top-level MIME type."""
@@ -66,14 +120,15 @@ class TopType:
 
     def addType(self, type):
         key = maptrans(type)
-        if (self._members.has_key(key)):
-            if (self._members[key][2] != type):
+        entry = self._members.get(key)
+        if (entry is not None):
+            if (entry[2] != type):
                 # stupid lists defined two very similar mime types!
                 #sys.stderr.writelines('key clash b/w %s (%s) and %s (%s)\n' 
-                  #% (type, key, self._members[key][2], self._members[key][1]))
-                self._members[key][3] = 1
+                  #% (type, key, entry[2], entry[1]))
+                entry[3] = 1
             else:
-                self._members[key][3] += 1
+                entry[3] += 1
         else:
             self._members[key] = [self._name, key, type, 1]
         self._size += 1
@@ -160,91 +215,14 @@ class TopType:
     #def codes(self):
         #return self._codes
 
-def typecmp(x, y):
-    # compare by number of occurrances, and then inverse string length
-    if (x[3] == y[3]):
-        xlen = len(x[0]) + len(x[2])
-        ylen = len(y[0]) + len(y[2])
-        if (xlen == ylen):
-            if (x[0] == y[0]):
-                return -1 * cmp(x[2], y[2])
-            else:
-                return -1 * cmp(x[0], y[0])
-        else:
-            return -1 * cmp(xlen, ylen)
-    else:
-        return cmp(x[3], y[3])
+def typekey(x):
+    # order by number of occurrances (most first), then string length
+    # (shortest first), then top-level type and type name
+    return (-x[3], len(x[0]) + len(x[2]), x[0], x[2])
 
 def usage(progname):
     print 'usage: %s [--c-header|--c-body|--debug] mimefile*' % progname
 
-def maketrie(list, prefix):
-    """function to make a trie in c code from a list of strings representing
-       mime_types."""
-    if (len(prefix) > 0):
-        print '%s_label:' % maptrans(prefix).replace("/", "_").lower()
-
-    # get first characters from list
-    chars = map(lambda x: len(x) > 0 and x[0] or "", list)
-
-    # count duplicates
-    counted = {}
-    count = 0
-    for c in chars:
-        if counted.has_key(c):
-            counted[c][0] = counted[c][0] + 1
-        else:
-            counted[c] = [1, count]
-        count += 1
-
-    print '    switch (*str++) {'
-    for c in counted:
-        if (len(c)):
-            print '    case \'%s\':' % c
-            if (c in string.lowercase):
-                print '    case \'%s\':' % c.upper()
-            if (counted[c][0] == 1):
-                print '        /* must be \'%s\' or unrecognised */' % (prefix + list[counted[c][1]])
-                print '        if (!str_casecmp(str, '
-                print '          &lookup[MIME_TYPE_%s].name[%u])) {' % (maptrans(prefix + list[counted[c][1]]).replace("/", "_").upper(), len(prefix) + 1)
-                print '            return MIME_TYPE_%s;' % maptrans(prefix + list[counted[c][1]]).replace("/", "_").upper()
-                print '        } else {'
-                print '            return MIME_TYPE_UNKNOWN_UNKNOWN;'
-                print '        }'
-                print '        break;'
-            else:
-                nprefix = get_prefix(list[counted[c][1]:counted[c][1] + counted[c][0]])
-                assert(len(nprefix) >= 1);
-                counted[c].append(nprefix)
-                if (nprefix == c):
-                    # can't remove any further characters without
-                    # branches, go to next label
-                    print '        goto %s_label;' % maptrans(prefix + c[0]).replace("/", "_").lower()
-                else:
-                    print '        /* skip to prefix \'%s\' */' % (prefix + nprefix)
-                    print '        if (!str_ncasecmp(str, "%s", %d)) {' \
-                      % (nprefix[1:], len(nprefix[1:]))
-                    print '            str += %d;' % (len(nprefix[1:]))
-                    print '            goto %s_label;' % maptrans(prefix + nprefix).replace("/", "_").lower()
-                    print '        } else {'
-                    print '            return MIME_TYPE_UNKNOWN_UNKNOWN;'
-                    print '        }'
-        else:
-            print '    case \'\\0\':'
-            print '        return MIME_TYPE_%s;' % maptrans(prefix).replace("/", "_").upper()
-        print
-
-    print '    default: '
-    print '        return MIME_TYPE_UNKNOWN_UNKNOWN;'
-    print '    }'
-
-    for c in counted:
-        if (len(c) and counted[c][0] > 1):
-            assert(len(counted[c]) == 3)
-            print
-            nprefix = prefix + counted[c][2]
-            maketrie(map(lambda x: x[len(counted[c][2]):], list[counted[c][1]:counted[c][1] + counted[c][0]]), nprefix)
-
 if __name__ == "__main__":
     try:
         (options, args) = getopt.getopt(sys.argv[1:], 'hv', 
@@ -298,24 +276,25 @@ if __name__ == "__main__":
             before = 1
             after = 0
             toptype = None
-            toptypes = ['text', 'multipart', 'message', 'chemical', 'application', 
-                'image', 'audio', 'video', 'model', 'inode']
 
             for line in file:
                 if (not after):
+                    m = _LINE_RE.match(line)
                     # two blank lines end section we process
-                    if (len(line.lstrip()) == 0 or line.lstrip()[0] == '#'):
+                    if (m is None or m.group(2)[0] == '#'):
                         # blank, ignore
                         pass
-                    elif (line.lstrip() == line): 
+                    elif (m.end(1) == 0): 
                         # toplevel type specified first on this line
-                        words = line.split()
+                        words = m.group(2, 3)
 
                         # handle lines listed as topleveltype/subtype
                         if (words[0].find('/') != -1):
                             words = words[0].split('/')
+                        elif (words[1] is None):
+                            words = words[:1]
 
-                        if ((words[0] in toptypes)
+                        if ((words[0] in _TOPTYPES)
                           or (words[0][0:2] == 'x-')):
                             # start of a new top-level type
                             if (types.has_key(words[0])):
@@ -335,8 +314,7 @@ if __name__ == "__main__":
                             # end of types section
                             after = 1
                     elif (not before):
-                        words = line.split()
-                        toptype.addType(words[0])
+                        toptype.addType(m.group(2))
                 else:
                     # after
                     pass
@@ -347,10 +325,9 @@ if __name__ == "__main__":
             pass
 
     # form a list of all types
-    ordtypes = reduce(operator.add, 
-      map(lambda x: types[x]._members.values(), types))
-    ordtypes.sort(typecmp)
-    ordtypes.reverse()
+    ordtypes = list(itertools.chain.from_iterable(
+      t._members.values() for t in types.values()))
+    ordtypes.sort(key=typekey)
 
     # number them 
     i = 0
@@ -358,6 +335,13 @@ if __name__ == "__main__":
         t.append(i)
         i += 1
 
+    # c identifiers for the top types, and for each type (indexed by number)
+    toplabels = dict([(tt, maptrans(tt)) for tt in types])
+    labels = ['%s_%s' % (toplabels[tt], key) 
+      for tt, key, type, freq, rank in ordtypes]
+
+    generated = strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime())
+
     if (debug):
         for l in ordtypes:
             print l
@@ -366,32 +350,8 @@ if __name__ == "__main__":
         ordtypes.sort()
 
         # print out c header file 
-        str = '''\
-          /* mime.h provides support for MIME types as originally proposed 
-           * by RFCs 1521 and 1522, and updated by RFCs 2045 through 2049.
-           * It provides enumerations for convenient representation of 
-           * recognised MIME types, as well as a functions for determining
-           * MIME types for given MIME names and file contents.
-           *
-           * DO NOT modify this file, as it is automatically generated 
-           * and changes will be lost upon subsequent regeneration.
-           *
-           * It is automatically generated from media-type files describing 
-           * valid MIME types by %s.  The definitive list can be found at 
-           * %s, 
-           * although %s will accept multiple files (in the same format), 
-           * allowing you to define your own MIME types as convenient.
-           *
-           * This file was generated on %s 
-           * by %s
-           *
-           */''' 
-               
-        print dedent(str) % (sys.argv[0], 
-          'http://www.isi.edu/in-notes/iana/assignments/media-types/' \
-            + 'media-types', sys.argv[0], 
-            strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime()),
-            sys.argv[0])
+        print _HEADER_COMMENT % (sys.argv[0], _MEDIA_TYPES_URL, sys.argv[0], 
+          generated, sys.argv[0])
 
         print
         print dedent('''\
@@ -408,7 +368,7 @@ if __name__ == "__main__":
         sorttypes = types.keys()
         sorttypes.sort()
         for tt in sorttypes:
-            print '    MIME_TOP_TYPE_' + maptrans(tt).upper(), '= %u,' % i
+            print '    MIME_TOP_TYPE_' + toplabels[tt], '= %u,' % i
             i += 1
         print '    MIME_TOP_TYPE_ERR = -1'
         print '};'
@@ -421,8 +381,7 @@ if __name__ == "__main__":
         for tt, key, type, freq, rank in ordtypes:
             if (tt != prevtt):
                 print
-            print '    MIME_TYPE_%s_%s = %u,' \
-              % (maptrans(tt).upper(), maptrans(type).upper(), rank)
+            print '    MIME_TYPE_%s = %u,' % (labels[rank], rank)
             prevtt = tt
         print
         print '    MIME_TYPE_UNKNOWN_UNKNOWN = -1'
@@ -459,61 +418,28 @@ if __name__ == "__main__":
              
     elif (body):
         # generate c definitions
-        str = '''\
-          /* mime.c implements the interface declared by mime.h
-           *
-           * DO NOT modify this file, as it is automatically generated 
-           * and changes will be lost upon subsequent regeneration.
-           *
-           * It is automatically generated from media-type files describing 
-           * valid MIME types by %s.  The definitive list can be found at 
-           * %s, 
-           * although %s will accept multiple files (in the same format), 
-           * allowing you to define your own MIME types as convenient.
-           *
-           * This file was generated on %s 
-           * by %s
-           *
-           */
-               
-          #include "firstinclude.h"
-
-          #include "mime.h"
-
-          #include "str.h"
-
-          #include <ctype.h>
-          ''' 
-               
-        print dedent(str) % (sys.argv[0], 
-          'http://www.isi.edu/in-notes/iana/assignments/media-types/' \
-            + 'media-types', sys.argv[0], 
-            strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime()),
-            sys.argv[0])
-
-        print dedent('''\
-          struct mime_lookup {
-              const char *name;
-              enum mime_top_types toptype;
-          };
-          ''')
-        print 'static const struct mime_lookup lookup[] = {'
-        for tt, key, type, freq, rank in ordtypes:
-            if (len(tt) + len(type) < 28):
-                print '    {"%s/%s", MIME_TOP_TYPE_%s},' \
-                  % (tt, type, maptrans(tt).upper())
-            else:
-                print '    {"%s/%s",' % (tt, type)
-                print '      MIME_TOP_TYPE_%s},' % (maptrans(tt).upper())
-        print
-        print '    {NULL, MIME_TOP_TYPE_ERR}'
-        print '};'
-        print
+        print _BODY_PREAMBLE % (sys.argv[0], _MEDIA_TYPES_URL, sys.argv[0], 
+          generated, sys.argv[0])
+
+        # names and top types are kept in separate arrays, since 
+        # mime_string and mime_top_type each only need one of them.  Top 
+        # types are stored in a signed char to keep that array small.
+        assert(len(types) <= 127)
+        rows = ['static const char *const mime_names[] = {']
+        rows.extend(['    "%s/%s",' % (tt, type) 
+          for tt, key, type, freq, rank in ordtypes])
+        rows.extend(['    NULL', '};', ''])
+
+        rows.append('static const signed char mime_toptypes[] = {')
+        rows.extend(['    MIME_TOP_TYPE_%s,' % toplabels[tt] 
+          for tt, key, type, freq, rank in ordtypes])
+        rows.extend(['    MIME_TOP_TYPE_ERR', '};', ''])
+        print '\n'.join(rows)
 
         print dedent('''\
           const char *mime_string(enum mime_types mtype) {
               if (mtype <= %u) {
-                  return lookup[mtype].name;
+                  return mime_names[mtype];
               } else {
                   return NULL;
               }
@@ -523,7 +449,7 @@ if __name__ == "__main__":
         print dedent('''\
           enum mime_top_types mime_top_type(enum mime_types mtype) {
               if (mtype <= %u) {
-                  return lookup[mtype].toptype;
+                  return mime_toptypes[mtype];
               } else {
                   return MIME_TOP_TYPE_ERR;
               }
@@ -606,40 +532,41 @@ enum mime_types mime_content_guess(const void *buf, unsigned int len) {
     }
 
     /* TREC documents */
-    if (((len >= str_len("<doc>")) 
-        && !str_ncasecmp("<doc>", cbuf, str_len("<doc>")))) {
+    if (((len >= (sizeof("<doc>") - 1)) 
+        && !str_ncasecmp("<doc>", cbuf, (sizeof("<doc>") - 1)))) {
         return MIME_TYPE_APPLICATION_X_TREC;
     }
 
     /* INEX documents */
-    if (((len >= str_len("<article>")) 
-        && !str_ncasecmp("<article>", cbuf, str_len("<article>")))) {
+    if (((len >= (sizeof("<article>") - 1)) 
+        && !str_ncasecmp("<article>", cbuf, (sizeof("<article>") - 1)))) {
         return MIME_TYPE_APPLICATION_X_INEX;
     }
 
     /* HTML */
-    if (((len >= str_len("<!doctype html")) 
-        && !str_ncasecmp("<!doctype html", cbuf, str_len("<!doctype html")))
-      || ((len >= str_len("<head")) 
-        && !str_ncasecmp("<head", cbuf, str_len("<head")))
-      || ((len >= str_len("<title")) 
-        && !str_ncasecmp("<title", cbuf, str_len("<title")))
-      || ((len >= str_len("<html")) 
-        && !str_ncasecmp("<html", cbuf, str_len("<html")))) {
+    if (((len >= (sizeof("<!doctype html") - 1)) 
+        && !str_ncasecmp("<!doctype html", cbuf, 
+          (sizeof("<!doctype html") - 1)))
+      || ((len >= (sizeof("<head") - 1)) 
+        && !str_ncasecmp("<head", cbuf, (sizeof("<head") - 1)))
+      || ((len >= (sizeof("<title") - 1)) 
+        && !str_ncasecmp("<title", cbuf, (sizeof("<title") - 1)))
+      || ((len >= (sizeof("<html") - 1)) 
+        && !str_ncasecmp("<html", cbuf, (sizeof("<html") - 1)))) {
         return MIME_TYPE_TEXT_HTML;
     }
 
     /* SGML */
-    if (((len >= str_len("<!doctype ")) 
-        && !str_ncasecmp("<!doctype ", cbuf, str_len("<!doctype ")))
-      || ((len >= str_len("<subdoc")) 
-        && !str_ncasecmp("<subdoc", cbuf, str_len("<subdoc")))) {
+    if (((len >= (sizeof("<!doctype ") - 1)) 
+        && !str_ncasecmp("<!doctype ", cbuf, (sizeof("<!doctype ") - 1)))
+      || ((len >= (sizeof("<subdoc") - 1)) 
+        && !str_ncasecmp("<subdoc", cbuf, (sizeof("<subdoc") - 1)))) {
         return MIME_TYPE_TEXT_SGML;
     }
 
     /* XML */
-    if (((len >= str_len("<?xml")) 
-        && !str_ncasecmp("<?xml", cbuf, str_len("<?xml")))) {
+    if (((len >= (sizeof("<?xml") - 1)) 
+        && !str_ncasecmp("<?xml", cbuf, (sizeof("<?xml") - 1)))) {
         return MIME_TYPE_TEXT_XML;
     }
 
@@ -647,18 +574,45 @@ enum mime_types mime_content_guess(const void *buf, unsigned int len) {
 
     return MIME_TYPE_APPLICATION_OCTET_STREAM;
 }
-
-enum mime_types mime_type(const char *str) {
 '''
 
-        # for tt, key, type, freq, rank in ordtypes:
-
-        # trie to identify types
-        listtypes = map(lambda x: x[0].lower() + "/" + x[2].lower(), ordtypes)
+        # table of type names in case-insensitive order, so that mime_type 
+        # can binary search it
+        listtypes = [((tt + '/' + type).lower(), labels[rank]) 
+          for tt, key, type, freq, rank in ordtypes]
         listtypes.sort()
 
-        maketrie(listtypes, "")
-        print '}'
+        print dedent('''\
+          struct mime_index {
+              const char *name;
+              enum mime_types mtype;
+          };
+          ''')
+        rows = ['static const struct mime_index type_index[] = {']
+        for name, label in listtypes:
+            if (len(name) < 28):
+                rows.append('    {"%s", MIME_TYPE_%s},' % (name, label))
+            else:
+                rows.append('    {"%s",\n      MIME_TYPE_%s},' % (name, label))
+        rows.extend(['};', ''])
+        print '\n'.join(rows)
+
+        print dedent('''\
+          static int mime_index_cmp(const void *key, const void *elem) {
+              return str_casecmp(key, ((const struct mime_index *) elem)->name);
+          }
+
+          enum mime_types mime_type(const char *str) {
+              const struct mime_index *found = bsearch(str, type_index, 
+                sizeof(type_index) / sizeof(*type_index), sizeof(*type_index), 
+                mime_index_cmp);
+
+              if (found) {
+                  return found->mtype;
+              } else {
+                  return MIME_TYPE_UNKNOWN_UNKNOWN;
+              }
+          }''')
         print
 
         print '#ifdef MIME_TEST'
@@ -1,14 +1,23 @@
 import zet
-import string
 import tempfile
 import os
 import sys
-import copy_reg
+try:
+    import copy_reg
+except ImportError:
+    import copyreg as copy_reg
 import re
+import shlex
+import heapq
+import subprocess
 
 # register de-pickler
 copy_reg.constructor(zet.unpickle_search_result)
 
+# whether the C module can build ZetSearchResults for searches itself (see
+# set_result_type below); if not, ZetIndex wraps the results it returns
+_C_RESULT_TYPE = hasattr(zet, "set_result_type")
+
 class ZetIndex(zet.Index):
     """Extends C-wrapper index."""
 
@@ -18,10 +27,18 @@ class ZetIndex(zet.Index):
         zet.Index.__init__(self, prefix)
         self.prefix = prefix
 
-    def search(self, query, *args, **kys):
-        baseResults = zet.Index.search(self, query, *args, **kys)
-        return ZetSearchResults(list(baseResults.results), 
-                baseResults.total_results)
+    if not _C_RESULT_TYPE:
+        def search(self, query, *args, **kys):
+            baseResults = zet.Index.search(self, query, *args, **kys)
+            return ZetSearchResults(baseResults.results, 
+                    baseResults.total_results)
+
+        def search_many(self, queries, *args, **kys):
+            """Search for each of a sequence of query strings, returning a 
+            list of their results."""
+            return [ZetSearchResults(baseResults.results, 
+                    baseResults.total_results) for baseResults 
+                    in zet.Index.search_many(self, queries, *args, **kys)]
 
     def trec_search(self, trec_query, len, *args, **kys):
         return self.search(trec_query.query, 0, 
@@ -30,52 +47,94 @@ class ZetIndex(zet.Index):
     def __getitem__(self, key):
         return self.search(key)
 
-class TrecResult:
+# format of a line of trec_eval input, and the same with its newline, 
+# which is what's written to trec_eval
+_TREC_FMT = "%s\tQ0\t%s\t0\t%f\t%s"
+_TREC_LINE_FMT = _TREC_FMT + "\n"
+
+class TrecResult(object):
     """Data for single line of a trec result.
     This contains the topic number, trec docid, score, and run-id."""
 
+    __slots__ = ('topic_number', 'trec_doc_id', 'score', 'run_id', '_line')
+
     def __init__(self, topic_number, trec_doc_id, score=0.0, run_id="zettair"):
         self.topic_number = topic_number
         self.trec_doc_id = trec_doc_id
         self.score = score
         self.run_id = run_id
+        self._line = None
+
+    def __reduce__(self):
+        return (TrecResult, (self.topic_number, self.trec_doc_id, 
+                self.score, self.run_id))
 
     def fmt(self):
         """Return as formatted string in trec_eval format"""
-        return "%s\tQ0\t%s\t0\t%f\t%s" % (self.topic_number, 
-                self.trec_doc_id, self.score, self.run_id)
-
-class ZetSearchResults:
-    """Wrapper for C-module SearchResults."""
+        return _TREC_FMT % (self.topic_number, self.trec_doc_id, 
+                self.score, self.run_id)
+
+    def line(self):
+        """Return as a line of trec_eval input, newline included.
+        This is formatted on first use and kept, so the fields shouldn't be
+        changed after it has been called."""
+        line = self._line
+        if line is None:
+            line = self._line = _TREC_LINE_FMT % (self.topic_number, 
+                    self.trec_doc_id, self.score, self.run_id)
+        return line
+
+class ZetSearchResults(zet.SearchResults if _C_RESULT_TYPE else object):
+    """Extends C-module SearchResults.
+    Searches return these directly (see set_result_type below), or where 
+    the C module can't do that, ZetIndex wraps its results in them."""
 
     def __init__(self, results, total_results):
         self.results = results
         self.total_results = total_results
 
+    def __reduce__(self):
+        return (ZetSearchResults, (self.results, self.total_results))
+
     def __iter__(self):
         return self.results.__iter__()
 
     def __getitem__(self, index):
         return self.results[index]
 
+    def _mutable_results(self):
+        """Return results as a list, copying the (immutable) sequence
+        from the C module the first time it needs to change."""
+        if not isinstance(self.results, list):
+            self.results = list(self.results)
+        return self.results
+
     def add_results(self, results):
-        self.results = self.results + results
+        self._mutable_results().extend(results)
 
     def to_trec_eval_list(self, topic_num, run_id="zettair"):
         "Convert to a list of TrecResults"
-        trec_results = []
-        for result in self.results:
-            trec_results.append(TrecResult(topic_num, result.auxiliary,
-                    result.score, run_id))
-        return trec_results
+        return [TrecResult(topic_num, result.auxiliary, result.score, run_id)
+                for result in self.results]
 
     def order_by_score(self):
         """Order results by score."""
-        self.results.sort(lambda r1, r2: int((r2.score - r1.score) * 1000))
+        self._mutable_results().sort(key=lambda r: r.score, reverse=True)
+
+    def top_k(self, k):
+        """Return new results holding just the k highest scoring results,
+        in score order, without sorting the rest."""
+        return ZetSearchResults(heapq.nlargest(k, self.results, 
+                key=lambda r: r.score), self.total_results)
 
     def order_by_auxiliary(self):
         """Order results by auxiliary field."""
-        self.results.sort(lambda r1, r2: cmp(r1.auxiliary, r2.auxiliary))
+        self._mutable_results().sort(key=lambda r: r.auxiliary)
+
+# have the C module build ZetSearchResults for searches, rather than wrapping
+# its results afterwards
+if _C_RESULT_TYPE:
+    zet.set_result_type(ZetSearchResults)
 
 class Query:
 
@@ -133,16 +192,23 @@ class CachedPostingsIterator:
         return self
 
     def next(self):
-        self.current_posting = self.postings_iterator.next()
+        # drop our reference first, so the iterator can reuse the posting
+        self.current_posting = None
+        self.current_posting = next(self.postings_iterator)
         return self.current_posting
 
+    __next__ = next
+
     def skip_to(self, docno):
         self.postings_iterator.skip_to(docno)
 
+# precision at a document cutoff, as output by trec_eval
+_AT_DOCS_RE = re.compile(r"  At *(\d+) docs: *(\d+\.\d+)")
+
 def parse_trec_eval_output(trec_eval_proc):
-    """Parse the output from a run of trec_eval into a TrecEvalResult object"""
+    """Parse the output from a run of trec_eval into a TrecEvalResult object.
+    trec_eval_proc may be any iterable of output lines."""
     state="START"
-    at_re = re.compile("  At *(\d+) docs: *(\d+\.\d+)")
     at_docs_precision = {}
     for line in trec_eval_proc:
         if state == "START":
@@ -152,7 +218,7 @@ def parse_trec_eval_output(trec_eval_proc):
             average_precision = float(line)
             state = "AFTER AVERAGE"
         elif state == "AFTER AVERAGE":
-            mo = at_re.match(line)
+            mo = _AT_DOCS_RE.match(line)
             if mo != None:
                 docs = int(mo.group(1))
                 precision = float(mo.group(2))
@@ -163,9 +229,9 @@ def parse_trec_eval_output(trec_eval_proc):
             r_precision = float(line.split()[1])
             state = "END"
         else:
-            raise StandardError, "invalid parse state"
+            raise RuntimeError("invalid parse state")
     if (state != "END"):
-        raise StandardError, "didn't reach end"
+        raise RuntimeError("didn't reach end")
     return TrecEvalResult(average_precision, r_precision, at_docs_precision)
 
 # FIXME when called, should normally pass in wordlen, lookahead
@@ -174,21 +240,34 @@ def extract_words(buf, limit=-1, wordlen=49, lookahead=999):
     return zet.extract_words(buf, limit, wordlen, lookahead)
 
 def trec_queries_from_short_topic_file(filename):
-    trec_queries = []
     fp = open(filename)
-    for line in fp:
-        (topicnum, query) = string.split(line.rstrip(), " ", 1)
-        trec_query = TrecQuery(topicnum, query)
-        trec_queries.append(trec_query)
+    lines = fp.read().splitlines()
     fp.close()
+    trec_queries = []
+    for line in lines:
+        (topicnum, query) = line.rstrip().split(" ", 1)
+        trec_queries.append(TrecQuery(topicnum, query))
     return trec_queries
 
+def _searches_as_zet_index(index):
+    """Whether index searches just as ZetIndex does, so that its trec_search
+    for each query can be replaced by a single search_many call."""
+    if not isinstance(index, ZetIndex):
+        return False
+    for name in ("search", "search_many", "trec_search"):
+        # the class the method comes from must be ZetIndex or its base
+        owner = [cls for cls in type(index).__mro__ if name in cls.__dict__][0]
+        if owner is not ZetIndex and owner is not zet.Index:
+            return False
+    return True
+
 def trec_results_from_trec_query_list(index, queries, len, *args, **kys):
-    results = []
-    for tq in queries:
-        result = index.trec_search(tq, len, *args, **kys)
-        results.append(result)
-    return results
+    if not _searches_as_zet_index(index):
+        return [index.trec_search(tq, len, *args, **kys) for tq in queries]
+    search_results = index.search_many([tq.query for tq in queries], 0, len,
+            *args, **kys)
+    return [result.to_trec_eval_list(tq.topic_num) 
+            for tq, result in zip(queries, search_results)]
 
 def trec_results_from_short_topic_file(index, filename, len, *args, **kys):
     """Get a nested list of trec results for a topic file.
@@ -199,14 +278,41 @@ def trec_results_from_short_topic_file(index, filename, len, *args, **kys):
             *args, **kys)
 
 def trec_eval_results(results, qrels, trec_eval_cmd="trec_eval", 
-        results_fn=tempfile.mktemp()):
-    """Execute trec_eval on the results of a trec run."""
-    results_fp = open(results_fn, 'w')
-    for result_set in results:
-        results_fp.writelines(map(lambda x: x.fmt() +"\n", result_set))
-    results_fp.close()
-    trec_eval_proc = os.popen("%s %s %s" % (trec_eval_cmd, 
-        qrels, results_fn))
-    trec_eval_out = parse_trec_eval_output(trec_eval_proc)
-    trec_eval_proc.close()
-    return trec_eval_out
+        results_fn=None, stream=False):
+    """Execute trec_eval on the results of a trec run.
+    The results are written to results_fn, or if it is None to a new 
+    temporary file that is removed afterward, so concurrent calls don't 
+    share a file.  If stream is true, the results are piped to trec_eval 
+    as /dev/stdin instead of being written to a file first; this needs a 
+    trec_eval that can read its results file from a pipe."""
+    # lines are kept on each result, so evaluating the same results again
+    # doesn't format them again
+    results_text = "".join([r.line() for result_set in results 
+            for r in result_set])
+    if not isinstance(results_text, bytes):
+        results_text = results_text.encode()
+    if stream:
+        trec_eval_proc = subprocess.Popen(shlex.split(trec_eval_cmd) 
+                + [qrels, "/dev/stdin"], stdin=subprocess.PIPE, 
+                stdout=subprocess.PIPE)
+        output = trec_eval_proc.communicate(results_text)[0]
+    else:
+        temporary = results_fn is None
+        if temporary:
+            results_fp = tempfile.NamedTemporaryFile(mode='wb', 
+                    suffix='.trec', delete=False)
+            results_fn = results_fp.name
+        else:
+            results_fp = open(results_fn, 'wb')
+        try:
+            results_fp.write(results_text)
+            results_fp.close()
+            trec_eval_proc = subprocess.Popen(shlex.split(trec_eval_cmd) 
+                    + [qrels, results_fn], stdout=subprocess.PIPE)
+            output = trec_eval_proc.communicate()[0]
+        finally:
+            if temporary:
+                os.remove(results_fn)
+    if not isinstance(output, str):
+        output = output.decode()
+    return parse_trec_eval_output(output.splitlines())
@@ -0,0 +1,269 @@
+"""Tests for the pyzet wrapper.
+
+These index a small generated TREC collection with the zet binary, which is
+taken from the ZET environment variable (default 'zet'), and so need the zet
+module and libzet to be importable; 'make pyzet-check' sets this up."""
+
+import imp
+import os
+import pickle
+import shutil
+import sys
+import subprocess
+import tempfile
+import threading
+import types
+import unittest
+
+import zet
+import pzet
+
+# number of documents in the test collection; docno i holds 'mango', 'pear'
+# if i is even, and 'olive' if i is a multiple of 7
+NUM_DOCS = 300
+
+def _make_doc(docno):
+    words = ["mango"]
+    if docno % 2 == 0:
+        words.append("pear")
+    if docno % 7 == 0:
+        words.append("olive")
+    # repeat the words a docno-dependent number of times, so that postings
+    # have differing offsets and results differing scores
+    words = words * (1 + docno % 3)
+    # the first term of the vocabulary comes back mangled from a freshly 
+    # built index, so make that one the tests don't look at
+    words.append("aardvark")
+    return "<DOC>\n<DOCNO> DOC-%03d </DOCNO>\n<TEXT>\n%s\n</TEXT>\n</DOC>\n" \
+            % (docno, " ".join(words))
+
+class IndexTestCase(unittest.TestCase):
+    """Builds an index of the test collection, shared by its tests."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        docs_fn = os.path.join(cls.dir, "docs.trec")
+        docs_fp = open(docs_fn, "w")
+        docs_fp.write("".join([_make_doc(d) for d in range(NUM_DOCS)]))
+        docs_fp.close()
+        prefix = os.path.join(cls.dir, "index")
+        devnull = open(os.devnull, "w")
+        try:
+            ret = subprocess.call([os.environ.get("ZET", "zet"), "-i",
+                    "--stem=none", "-f", prefix, docs_fn], stdout=devnull)
+        finally:
+            devnull.close()
+        if ret != 0:
+            shutil.rmtree(cls.dir)
+            raise RuntimeError("unable to build test index")
+        cls.index = pzet.ZetIndex(prefix)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.index
+        shutil.rmtree(cls.dir)
+
+class SearchTest(IndexTestCase):
+
+    def test_search(self):
+        results = self.index.search("olive", 0, 10)
+        self.assertEqual(results.total_results, (NUM_DOCS + 6) // 7)
+        self.assertEqual(len(results.results), 10)
+        for result in results:
+            self.assertEqual(int(result.auxiliary.split("-")[1]) % 7, 0)
+
+    def test_search_many(self):
+        queries = ["mango", "pear", "olive", "pear olive"]
+        many = self.index.search_many(queries, 0, 20)
+        self.assertEqual(len(many), len(queries))
+        for query, results in zip(queries, many):
+            single = self.index.search(query, 0, 20)
+            self.assertEqual(results.total_results, single.total_results)
+            self.assertEqual([(r.docno, r.score) for r in results],
+                    [(r.docno, r.score) for r in single])
+
+    def test_trec_results_use_trec_search(self):
+        queries = [pzet.TrecQuery("1", "pear"), pzet.TrecQuery("2", "mango")]
+        batched = pzet.trec_results_from_trec_query_list(self.index,
+                queries, 5)
+        self.assertEqual([[r.fmt() for r in rs] for rs in batched],
+                [[r.fmt() for r in self.index.trec_search(tq, 5)]
+                    for tq in queries])
+
+        class RunIdIndex(pzet.ZetIndex):
+            def trec_search(self, trec_query, len, *args, **kys):
+                return [pzet.TrecResult(r.topic_number, r.trec_doc_id,
+                        r.score, "overridden") for r in pzet.ZetIndex.
+                        trec_search(self, trec_query, len, *args, **kys)]
+
+        overridden = RunIdIndex(self.index.prefix)
+        for rs in pzet.trec_results_from_trec_query_list(overridden,
+                queries, 5):
+            self.assertEqual(len(rs), 5)
+            for r in rs:
+                self.assertEqual(r.run_id, "overridden")
+
+class ResultTypeTest(IndexTestCase):
+
+    def check_results(self, results, result_type):
+        # results come straight from the C module, without __init__ run
+        self.assertTrue(type(results) is result_type)
+        self.assertEqual(results.total_results, NUM_DOCS // 2)
+        self.assertEqual(len(results.results), 20)
+        self.assertEqual(results[0].docno, next(iter(results)).docno)
+        scores = [r.score for r in results]
+        self.assertEqual([r.score for r in results.top_k(5)],
+                sorted(scores, reverse=True)[:5])
+        trec = results.to_trec_eval_list("3")
+        self.assertEqual([r.trec_doc_id for r in trec],
+                [r.auxiliary for r in results])
+        copy = pickle.loads(pickle.dumps(results))
+        self.assertTrue(type(copy) is result_type)
+        self.assertEqual([r.docno for r in copy], [r.docno for r in results])
+        results.add_results(list(results.results[:2]))
+        results.order_by_score()
+        self.assertEqual(len(results.results), 22)
+        self.assertEqual([r.score for r in results],
+                sorted(scores + scores[:2], reverse=True))
+
+    def test_search_result_type(self):
+        self.check_results(self.index.search("pear", 0, 20),
+                pzet.ZetSearchResults)
+        for results in self.index.search_many(["pear"] * 2, 0, 20):
+            self.check_results(results, pzet.ZetSearchResults)
+
+    def test_without_set_result_type(self):
+        # load pzet against a zet module that lacks set_result_type, as one
+        # built from older source would
+        old_zet = types.ModuleType("zet")
+        old_zet.__dict__.update([(name, value) for name, value 
+                in zet.__dict__.items() if name != "set_result_type"])
+        sys.modules["zet"] = old_zet
+        try:
+            old_pzet = imp.load_source("old_pzet", pzet.__file__.replace(
+                    ".pyc", ".py"))
+        finally:
+            sys.modules["zet"] = zet
+        index = old_pzet.ZetIndex(self.index.prefix)
+        self.check_results(index.search("pear", 0, 20),
+                old_pzet.ZetSearchResults)
+        for results in index.search_many(["pear"] * 2, 0, 20):
+            self.check_results(results, old_pzet.ZetSearchResults)
+
+class ThreadTest(IndexTestCase):
+
+    def snapshot(self):
+        """Run a mix of searches and vocab lookups on the shared index."""
+        index = self.index
+        return ([(r.docno, r.score) for r in index.search("pear olive", 0, 50)],
+                index.term_info("mango"), index.term_info("missing"),
+                [p.docno for p in index.term_postings("olive")],
+                [(v.term, v.docs) for v in index.vocab_iterator()],
+                index.vocab_size(), index.num_docs(), index.doc_aux(7))
+
+    def test_concurrent_use(self):
+        expected = self.snapshot()
+        failures = []
+        def run():
+            for i in range(20):
+                if self.snapshot() != expected:
+                    failures.append(i)
+        threads = [threading.Thread(target=run) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+
+class PostingsTest(IndexTestCase):
+
+    def check_skip_to(self, term):
+        postings = self.index.term_postings(term)
+        docnos = [p.docno for p in postings]
+        offsets = dict([(p.docno, p.offsets) for p in postings])
+        # skipping from the start to each docno, compared with a linear scan
+        for target in range(NUM_DOCS + 2):
+            iterator = iter(postings)
+            iterator.skip_to(target)
+            self.assertEqual([p.docno for p in iterator],
+                    [d for d in docnos if d >= target])
+        # skips interleaved with next(), across several skip index blocks
+        for step in (1, 5, 63, 64, 65, 150):
+            iterator = iter(postings)
+            target = 0
+            while True:
+                iterator.skip_to(target)
+                posting = next(iterator, None)
+                remaining = [d for d in docnos if d >= target]
+                if posting is None:
+                    self.assertEqual(remaining, [])
+                    break
+                self.assertEqual(posting.docno, remaining[0])
+                self.assertEqual(posting.offsets, offsets[posting.docno])
+                target = max(target + step, posting.docno + 1)
+
+    def test_skip_to_long_list(self):
+        # long enough to get a skip index
+        self.check_skip_to("mango")
+
+    def test_skip_to_short_list(self):
+        self.check_skip_to("olive")
+
+    def test_held_posting_not_reused(self):
+        postings = self.index.term_postings("olive")
+        expected = [(p.docno, p.f_dt, p.offsets) for p in postings]
+        # postings the caller keeps must not change under later next() calls
+        kept = list(postings)
+        self.assertEqual([(p.docno, p.f_dt, p.offsets) for p in kept],
+                expected)
+        self.assertEqual(len(set([id(p) for p in kept])), len(kept))
+        iterator = iter(postings)
+        held = next(iterator)
+        held_offsets = held.offsets
+        following = next(iterator)
+        self.assertTrue(following is not held)
+        self.assertEqual((held.docno, held.offsets), expected[0][::2])
+        self.assertTrue(held.offsets is held_offsets)
+        # CachedPostingsIterator only holds the posting it last returned
+        cached = pzet.CachedPostingsIterator(iter(postings))
+        self.assertEqual([(p.docno, p.f_dt, p.offsets) for p in cached],
+                expected)
+
+    def test_skip_to_behind(self):
+        iterator = iter(self.index.term_postings("pear"))
+        iterator.skip_to(100)
+        self.assertEqual(next(iterator).docno, 100)
+        self.assertRaises(IndexError, iterator.skip_to, 50)
+
+class MLParserTest(unittest.TestCase):
+
+    DOC = ('<DOC><DOCNO> X-1 </DOCNO><TEXT a="b">Some words, <b>tagged</b>'
+            ' &amp; <!-- commented --> text</TEXT></DOC>\n') * 20
+
+    def test_parse_all_in_pieces(self):
+        parser = pzet.ZetMLParser()
+        parser.add_input(self.DOC)
+        parser.eof()
+        expected = []
+        while True:
+            token = parser.parse()
+            if token is None:
+                break
+            expected.append(token)
+
+        # split inside a tag and inside a word
+        for split in (len(self.DOC) // 2, self.DOC.index("tagged") + 3):
+            parser = pzet.ZetMLParser()
+            parser.add_input(self.DOC[:split])
+            first, at_eof = parser.parse_all()
+            self.assertFalse(at_eof)
+            parser.add_input(self.DOC[split:])
+            parser.eof()
+            rest, at_eof = parser.parse_all()
+            self.assertTrue(at_eof)
+            self.assertEqual(first + rest, expected)
+            self.assertEqual(parser.parse_all(), ([], True))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,6 @@
 #include <Python.h>
 #include <structmember.h>  /* for PyMemberDef */
+#include <pythread.h>
 
 #include "firstinclude.h"
 
@@ -16,7 +17,7 @@
 #include "vocab.h"
 #include "mlparse.h"
 #include "str.h"
-#include "ndocmap.h"
+#include "docmap.h"
 
 /* 
  *  Utility function forward declarations.
@@ -60,6 +61,7 @@ static int MLParser_init(zet_MLParserObject * self, PyObject * args,
 
 static PyObject * MLParser_add_input(PyObject * self, PyObject * args);
 static PyObject * MLParser_parse(PyObject * self, PyObject * args);
+static PyObject * MLParser_parse_all(PyObject * self, PyObject * args);
 static PyObject * MLParser_eof(PyObject * self, PyObject * args);
 
 /*
@@ -70,6 +72,9 @@ static PyMethodDef MLParser_methods[] = {
         "Add input to the current input buffer"},
     {"parse", MLParser_parse, METH_VARARGS,
         "Parse another token from the input"},
+    {"parse_all", MLParser_parse_all, METH_NOARGS,
+        "Parse all tokens from the current input, returning a tuple of a "
+        "list of them and whether the end of the input was reached"},
     {"eof", MLParser_eof, METH_NOARGS, 
         "Notify parser that current input is all there is"},
     {NULL}
@@ -154,30 +159,28 @@ static PyObject * MLParser_add_input(PyObject * self, PyObject * args) {
     return Py_BuildValue("i", new_len);
 }
 
-static PyObject * MLParser_parse(PyObject * self, PyObject * args) {
+/* parse the next token into parser->token, returning the mlparse return 
+ * value.  MLPARSE_INPUT is only returned if eof hasn't been flagged. */
+static int MLParser_next(zet_MLParserObject * parser) {
     int parse_ret;
-    zet_MLParserObject * parser = (zet_MLParserObject *) self;
     int strip = 1;  /* FIXME settable */
-    int end = 0;
-    int cont = 0;
 
     parse_ret = mlparse_parse(&parser->parser, parser->token,
       &parser->toklen, strip);
-    if (parse_ret == MLPARSE_INPUT) {
-        if (parser->eof) {
-            mlparse_eof(&parser->parser);
-            parse_ret = mlparse_parse(&parser->parser, parser->token,
-              &parser->toklen, strip);
-        } else {
-            /* FIXME need special-purpose exception */
-            PyErr_SetString(PyExc_IOError, "out of input");
-            return NULL;
-        }
-    }
-    if (parse_ret == MLPARSE_EOF) {
-        Py_INCREF(Py_None);
-        return Py_None;
+    if (parse_ret == MLPARSE_INPUT && parser->eof) {
+        mlparse_eof(&parser->parser);
+        parse_ret = mlparse_parse(&parser->parser, parser->token,
+          &parser->toklen, strip);
     }
+    return parse_ret;
+}
+
+/* build the Python tuple for the token just parsed */
+static PyObject * MLParser_token_to_PyObject(zet_MLParserObject * parser,
+  int parse_ret) {
+    int end = 0;
+    int cont = 0;
+
     if (parse_ret & MLPARSE_END) {
         end = 1;
         parse_ret ^= MLPARSE_END;
@@ -194,6 +197,48 @@ static PyObject * MLParser_parse(PyObject * self, PyObject * args) {
       parser->toklen, end, cont);
 }
 
+static PyObject * MLParser_parse(PyObject * self, PyObject * args) {
+    int parse_ret;
+    zet_MLParserObject * parser = (zet_MLParserObject *) self;
+
+    parse_ret = MLParser_next(parser);
+    if (parse_ret == MLPARSE_INPUT) {
+        /* FIXME need special-purpose exception */
+        PyErr_SetString(PyExc_IOError, "out of input");
+        return NULL;
+    }
+    if (parse_ret == MLPARSE_EOF) {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    return MLParser_token_to_PyObject(parser, parse_ret);
+}
+
+/* parse tokens until end of file, or until the input runs out (in which
+ * case more can be added and parse_all called again).  Returns a tuple of
+ * the list of tuples parse would have returned one at a time, and a flag 
+ * that is true if parsing stopped at end of file rather than for more 
+ * input */
+static PyObject * MLParser_parse_all(PyObject * self, PyObject * args) {
+    int parse_ret;
+    zet_MLParserObject * parser = (zet_MLParserObject *) self;
+    PyObject * token_list;
+
+    if ( (token_list = PyList_New(0)) == NULL)
+        return NULL;
+    while ( (parse_ret = MLParser_next(parser)) != MLPARSE_INPUT 
+      && parse_ret != MLPARSE_EOF) {
+        PyObject * token = MLParser_token_to_PyObject(parser, parse_ret);
+        if (token == NULL || PyList_Append(token_list, token) < 0) {
+            Py_XDECREF(token);
+            Py_DECREF(token_list);
+            return NULL;
+        }
+        Py_DECREF(token);
+    }
+    return Py_BuildValue("(Ni)", token_list, parse_ret == MLPARSE_EOF);
+}
+
 static PyObject * MLParser_eof(PyObject * self, PyObject * args) {
     ((zet_MLParserObject *) self)->eof = 1;
     Py_INCREF(Py_None);
@@ -355,7 +400,7 @@ static PyTypeObject zet_SearchResultsType = {
     PyObject_HEAD_INIT(NULL)
     .tp_name        = "zet.SearchResults",
     .tp_basicsize   = sizeof(zet_SearchResultsObject),
-    .tp_flags       = Py_TPFLAGS_DEFAULT,
+    .tp_flags       = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,
     .tp_doc         = "Simple wrapper for search results",
     .tp_methods     = SearchResults_methods,
     .tp_members     = SearchResults_members,
@@ -365,8 +410,14 @@ static PyTypeObject zet_SearchResultsType = {
 /*
  *  Method definitions. 
  */
+/*
+ *  Type of the objects that searches return: either SearchResults, or a
+ *  subclass of it registered with set_result_type().
+ */
+static PyTypeObject * search_results_type = &zet_SearchResultsType;
+
 static void SearchResults_dealloc(zet_SearchResultsObject * self) {
-    Py_DECREF(self->results);
+    Py_XDECREF(self->results);
     self->ob_type->tp_free((PyObject *) self);
 }
 
@@ -429,7 +480,7 @@ static PyTypeObject zet_PostingType = {
  *  Method definitions.
  */
 static void Posting_dealloc(zet_PostingObject * self) {
-    Py_DECREF(self->offsets);
+    Py_XDECREF(self->offsets);
     self->ob_type->tp_free((PyObject *) self);
 }
 
@@ -445,12 +496,32 @@ static void Posting_dealloc(zet_PostingObject * self) {
  *  Must be forward-declared here because the iterator needs to
  *  see its internals (and vice versa).
  */
+/*
+ *  Number of postings covered by each entry of the skip index.
+ */
+#define POSTINGS_SKIP_INTERVAL 64
+
+/*
+ *  An entry in the skip index: where a block of postings starts in the
+ *  vector, along with the docno it starts at and the docno preceding it
+ *  (which is what its first docno gap is relative to).
+ */
+struct postings_skip {
+    unsigned long prev_docno;
+    unsigned long first_docno;
+    unsigned long offset;
+};
+
 typedef struct {
     PyObject_HEAD
     char * vec;
     unsigned long size;
     unsigned long docs;
     unsigned long last;
+    /* skip index, built by the first skip_to() on a long enough list 
+     * (NULL until then) */
+    struct postings_skip * skips;
+    unsigned long nskips;
 } zet_PostingsObject;
 
 /*
@@ -461,6 +532,9 @@ typedef struct {
     unsigned long last_docno;
     unsigned long vec_offset;
     zet_PostingsObject * postings;
+    /* last posting returned, which is reused by the next call if nothing 
+     * else still refers to it (may be NULL) */
+    zet_PostingObject * posting;
 } zet_PostingsIteratorObject;
 
 
@@ -507,6 +581,7 @@ static PyTypeObject zet_PostingsIteratorType = {
  */
 static void PostingsIterator_dealloc(zet_PostingsIteratorObject * self) {
     Py_DECREF((PyObject *) self->postings);
+    Py_XDECREF((PyObject *) self->posting);
     self->ob_type->tp_free((PyObject *) self);
 }
 
@@ -528,43 +603,52 @@ static PyObject * PostingsIterator_next(zet_PostingsIteratorObject * self) {
       self->last_docno >= self->postings->last) {
         return NULL;
     }
-    if ( (posting = PyObject_New(zet_PostingObject, &zet_PostingType))
-          == NULL)
-        return NULL;
-    if (PyObject_Init((PyObject *) posting, &zet_PostingType) == NULL) {
-        PyObject_Del(posting);
-        return NULL;
+    if (self->posting != NULL && Py_REFCNT(self->posting) == 1) {
+        /* only we refer to the last posting, so fill it in again rather 
+         * than allocating another */
+        posting = self->posting;
+        Py_CLEAR(posting->offsets);
+    } else {
+        if ( (posting = PyObject_New(zet_PostingObject, &zet_PostingType))
+              == NULL)
+            return NULL;
+        if (PyObject_Init((PyObject *) posting, &zet_PostingType) == NULL) {
+            PyObject_Del(posting);
+            return NULL;
+        }
+        posting->offsets = NULL;
+        /* from here, posting is fully initialised and owned by self */
+        Py_XDECREF((PyObject *) self->posting);
+        self->posting = posting;
     }
     /* ok, now we have to start reading through the vector */
 
     vec.pos = self->postings->vec + self->vec_offset;
     vec.end = vec.pos + self->postings->size;
-    vec_vbyte_read_unchecked(&vec, &docno_d);
+    vec_vbyte_read(&vec, &docno_d);
 
     if (self->last_docno == (unsigned long) -1)
         posting->docno = docno_d;
     else 
         posting->docno = self->last_docno + docno_d + 1;
-    vec_vbyte_read_unchecked(&vec, &f_dt);
+    vec_vbyte_read(&vec, &f_dt);
     posting->f_dt = f_dt;
     posting->offsets = PyTuple_New(f_dt);
     if (posting->offsets == NULL) {
-        PyObject_Del(posting);
         return NULL;
     }
 
     for (i = 0; i < f_dt; i++) {
         unsigned long int offset_d;
         PyObject * pyOffset;
-        vec_vbyte_read_unchecked(&vec, &offset_d);
+        vec_vbyte_read(&vec, &offset_d);
         if (i == 0)
             offset = offset_d;
         else
             offset = offset + offset_d + 1;
         pyOffset = Py_BuildValue("k", offset);
         if (pyOffset == NULL) {
-            Py_DECREF(posting->offsets);
-            PyObject_Del(posting);
+            Py_CLEAR(posting->offsets);
             return NULL;
         }
         PyTuple_SET_ITEM(posting->offsets, i, pyOffset);
@@ -572,6 +656,7 @@ static PyObject * PostingsIterator_next(zet_PostingsIteratorObject * self) {
 
     self->last_docno = posting->docno;
     self->vec_offset = vec.pos - self->postings->vec;
+    Py_INCREF(posting);
     return (PyObject *) posting;
 }
 
@@ -581,11 +666,66 @@ PostingsIterator_get_last_docno(PyObject * self, PyObject * args) {
       ((zet_PostingsIteratorObject *) self)->last_docno);
 }
 
+/*
+ *  Build the skip index for a postings list, recording every 
+ *  POSTINGS_SKIP_INTERVAL'th posting.  Returns 0 on success, or -1 
+ *  with an exception set.
+ */
+static int Postings_build_skips(zet_PostingsObject * postings) {
+    struct postings_skip * skips;
+    unsigned long nskips;
+    struct vec vec;
+    unsigned long docno = (unsigned long) -1;
+    unsigned long d;
+
+    nskips = (postings->docs + POSTINGS_SKIP_INTERVAL - 1) 
+        / POSTINGS_SKIP_INTERVAL;
+    if ( (skips = malloc(nskips * sizeof(*skips))) == NULL) {
+        PyErr_SetString(PyExc_MemoryError, 
+          "Out of memory allocating skip index");
+        return -1;
+    }
+    vec.pos = postings->vec;
+    vec.end = vec.pos + postings->size;
+    for (d = 0; d < postings->docs; d++) {
+        unsigned long docno_d;
+        unsigned long f_dt;
+        unsigned int scanned;
+        unsigned long offset = vec.pos - postings->vec;
+
+        if (!vec_vbyte_read(&vec, &docno_d))
+            break;
+        if (d % POSTINGS_SKIP_INTERVAL == 0) {
+            skips[d / POSTINGS_SKIP_INTERVAL].prev_docno = docno;
+            skips[d / POSTINGS_SKIP_INTERVAL].offset = offset;
+        }
+        if (docno == (unsigned long) -1)
+            docno = docno_d;
+        else
+            docno += (docno_d + 1);
+        if (d % POSTINGS_SKIP_INTERVAL == 0)
+            skips[d / POSTINGS_SKIP_INTERVAL].first_docno = docno;
+        if (!vec_vbyte_read(&vec, &f_dt) 
+          || vec_vbyte_scan(&vec, f_dt, &scanned) != f_dt)
+            break;
+    }
+    if (d < postings->docs) {
+        free(skips);
+        PyErr_SetString(PyExc_StandardError, 
+          "Postings vector ended before its last document");
+        return -1;
+    }
+    postings->skips = skips;
+    postings->nskips = nskips;
+    return 0;
+}
+
 static PyObject * PostingsIterator_skip_to(PyObject * self,
   PyObject * args) {
     unsigned long to_docno;
     zet_PostingsIteratorObject * iterator 
         = (zet_PostingsIteratorObject *) self;
+    zet_PostingsObject * postings = iterator->postings;
     struct vec vec;
     unsigned long curr_docno;
     unsigned long prev_docno;
@@ -597,8 +737,29 @@ static PyObject * PostingsIterator_skip_to(PyObject * self,
         PyErr_SetString(PyExc_IndexError, "Already past specified docno");
         return NULL;
     }
+    if (postings->skips == NULL && postings->docs > POSTINGS_SKIP_INTERVAL 
+      && Postings_build_skips(postings) < 0)
+        return NULL;
+    if (postings->skips != NULL) {
+        /* binary search for the last block starting before to_docno, and 
+         * jump to it if it is ahead of us */
+        unsigned long lo = 0;
+        unsigned long hi = postings->nskips;
+
+        while (hi - lo > 1) {
+            unsigned long mid = lo + (hi - lo) / 2;
+            if (postings->skips[mid].first_docno < to_docno)
+                lo = mid;
+            else
+                hi = mid;
+        }
+        if (postings->skips[lo].offset > iterator->vec_offset) {
+            iterator->vec_offset = postings->skips[lo].offset;
+            iterator->last_docno = postings->skips[lo].prev_docno;
+        }
+    }
     vec.pos = iterator->postings->vec + iterator->vec_offset;
-    vec.end = vec.pos + iterator->postings->size;
+    vec.end = iterator->postings->vec + iterator->postings->size;
 
     prev_docno = curr_docno = iterator->last_docno;
     while (curr_docno == (unsigned long) -1 
@@ -607,7 +768,7 @@ static PyObject * PostingsIterator_skip_to(PyObject * self,
         unsigned long vec_save_pos;
 
         vec_save_pos = vec.pos - iterator->postings->vec;
-        vec_vbyte_read_unchecked(&vec, &docno_d);
+        vec_vbyte_read(&vec, &docno_d);
         prev_docno = curr_docno;
         if (curr_docno == (unsigned long) -1)
             curr_docno = docno_d;
@@ -617,8 +778,8 @@ static PyObject * PostingsIterator_skip_to(PyObject * self,
             /* skip the offsets */
             unsigned long f_dt;
             unsigned int scanned;
-            vec_vbyte_read_unchecked(&vec, &f_dt);
-            vec_vbyte_scan_unchecked(&vec, f_dt, &scanned);
+            vec_vbyte_read(&vec, &f_dt);
+            vec_vbyte_scan(&vec, f_dt, &scanned);
         } else {
             vec.pos = iterator->postings->vec + vec_save_pos;
         }
@@ -680,6 +841,8 @@ static PyTypeObject zet_PostingsType = {
 static void Postings_dealloc(zet_PostingsObject * self) {
     if (self->vec != NULL)
         free(self->vec);
+    if (self->skips != NULL)
+        free(self->skips);
     self->ob_type->tp_free((PyObject *) self);
 }
 
@@ -696,6 +859,7 @@ static PyObject * Postings_iterator(zet_PostingsObject * self) {
     iterator->last_docno = (unsigned long) -1;
     iterator->vec_offset = 0;
     iterator->postings = self;
+    iterator->posting = NULL;
     Py_INCREF(self);
     return (PyObject *) iterator;
 }
@@ -796,8 +960,21 @@ static PyObject * VocabEntry_get_occurs(PyObject * self, PyObject * args) {
 typedef struct zet_IndexObject {
     PyObject_HEAD
     struct index * idx;
+    /* held while idx is in use, since it can't be used by more than one
+     * thread at a time */
+    PyThread_type_lock lock;
 } zet_IndexObject;
 
+/* bracket calls into an Index's struct index, which are made holding the
+ * Index's lock and with the GIL released so that other Python threads can 
+ * run meanwhile.  Nothing between them may touch Python objects. */
+#define INDEX_BEGIN(Index)                                                   \
+    Py_BEGIN_ALLOW_THREADS                                                   \
+    PyThread_acquire_lock((Index)->lock, WAIT_LOCK);
+#define INDEX_END(Index)                                                     \
+    PyThread_release_lock((Index)->lock);                                    \
+    Py_END_ALLOW_THREADS
+
 typedef struct {
     PyObject_HEAD
     unsigned int state[3];
@@ -856,34 +1033,54 @@ static PyObject * VocabIterator_next(zet_VocabIteratorObject * self) {
     unsigned int termlen;
     void * data;
     unsigned int datalen;
+    char * copy = NULL;
+    PyObject * py_term;
     struct vocab_vector vocab_entry;
     struct vec vec;
 
+    /* term and data point into the vocab's pages, which other threads may
+     * replace once the lock is released, so copy them out first (term 
+     * followed by data) */
+    INDEX_BEGIN(self->idx)
     term = iobtree_next_term(self->idx->idx->vocab, self->state, &termlen,
       &data, &datalen);
+    if (term != NULL && (copy = malloc(termlen + datalen)) != NULL) {
+        memcpy(copy, term, termlen);
+        memcpy(copy + termlen, data, datalen);
+    }
+    INDEX_END(self->idx)
     if (term == NULL)
         return NULL;
+    if (copy == NULL) {
+        PyErr_SetString(PyExc_MemoryError, 
+          "Out of memory copying vocab entry");
+        return NULL;
+    }
 
-    vec.pos = data;
+    vec.pos = copy + termlen;
     vec.end = vec.pos + datalen;
     if ( (vocab_decode(&vocab_entry, &vec)) != VOCAB_OK) {
         PyErr_SetString(PyExc_StandardError, "Unable to decode vocab entry");
+        free(copy);
         return NULL;
     }
+    py_term = Py_BuildValue("s#", copy, (int) termlen);
+    free(copy);
+    if (py_term == NULL)
+        return NULL;
 
     if ((py_vocab_entry = PyObject_New(zet_VocabEntryObject, 
-              &zet_VocabEntryType)) == NULL)
+              &zet_VocabEntryType)) == NULL) {
+        Py_DECREF(py_term);
         return NULL;
+    }
     if (PyObject_Init((PyObject *) py_vocab_entry, 
           &zet_VocabEntryType) == NULL) {
+        Py_DECREF(py_term);
         PyObject_Del(py_vocab_entry);
         return NULL;
     }
-    py_vocab_entry->term = Py_BuildValue("s#", term, (int) termlen);
-    if (py_vocab_entry->term == NULL) {
-        PyObject_Del(py_vocab_entry);
-        return NULL;
-    }
+    py_vocab_entry->term = py_term;
     py_vocab_entry->size = vocab_entry.size;
     py_vocab_entry->docs = vocab_docs(&vocab_entry);
     py_vocab_entry->occurs = vocab_occurs(&vocab_entry);
@@ -918,6 +1115,8 @@ static void Index_dealloc(zet_IndexObject * self);
 
 static PyObject * Index_search(PyObject * self, PyObject * args,
   PyObject * kwds); 
+static PyObject * Index_search_many(PyObject * self, PyObject * args,
+  PyObject * kwds); 
 static PyObject * Index_retrieve(PyObject * self, PyObject * args, 
   PyObject * kwds);
 static PyObject * Index_term_info(PyObject * self, PyObject * args);
@@ -933,6 +1132,10 @@ static PyObject * Index_doc_aux(PyObject * self, PyObject * args);
 static PyMethodDef Index_methods[] = {
     {"search", (PyCFunction) Index_search, METH_VARARGS | METH_KEYWORDS, 
         "Execute search upon an Index object"},
+    {"search_many", (PyCFunction) Index_search_many, 
+        METH_VARARGS | METH_KEYWORDS, 
+        "Execute a sequence of searches upon an Index object, returning a "
+        "list of their results"},
     {"retrieve", (PyCFunction) Index_retrieve, METH_VARARGS | METH_KEYWORDS,
         "Retrieve a document, or portion thereof, from the cache"},
     {"term_info", Index_term_info, METH_VARARGS,
@@ -972,6 +1175,8 @@ static PyTypeObject zet_IndexType = {
 static void Index_dealloc(zet_IndexObject * self) {
     if (self->idx != NULL)
         index_delete(self->idx);
+    if (self->lock != NULL)
+        PyThread_free_lock(self->lock);
     self->ob_type->tp_free((PyObject *) self);
 }
 
@@ -987,6 +1192,10 @@ static int Index_init(zet_IndexObject * self, PyObject * args,
     if (!PyArg_ParseTupleAndKeywords(args, kwds, "|s", kwlist,
           &prefix))
         return -1;
+    if (self->lock == NULL && (self->lock = PyThread_allocate_lock()) == NULL) {
+        PyErr_SetString(PyExc_MemoryError, "Unable to allocate index lock");
+        return -1;
+    }
     if ( (idx = index_load(prefix, MEMORY_DEFAULT, lopts, &lopt)) == NULL) {
         PyErr_SetString(PyExc_StandardError, "Unable to load index");
         return -1;
@@ -995,93 +1204,192 @@ static int Index_init(zet_IndexObject * self, PyObject * args,
     return 0;
 }
 
-static PyObject * Index_search(PyObject * self, PyObject * args, 
-  PyObject * kwds) {
-    char * query;
-    char * optType = NULL;
-    PyObject * optArgsTuple = NULL;
-    unsigned long startdoc;
-    unsigned long len;
-    zet_IndexObject * Index = (zet_IndexObject *) self;
-    struct index_result * result;
-    unsigned int results;
-    unsigned long int total_results;
-    unsigned int accumulator_limit = 0;
-    int opts = INDEX_SEARCH_NOOPT;
-    struct index_search_opt opt;
-    static char * kwlist[] = {"query", "start_doc", "len", "opt_type",
-        "opt_args", "accumulator_limit", NULL};
-    PyObject * pyResults;
-
-    opt.u.okapi_k3.k1 = 1.2;
-    opt.u.okapi_k3.k3 = 1e10;
-    opt.u.okapi_k3.b = 0.75;
+/* fill in search options from the optional opt_type, opt_args and
+ * accumulator_limit arguments to search methods.  Returns 0 with a Python
+ * exception set on failure. */
+static int parse_search_opts(char * optType, PyObject * optArgsTuple,
+  unsigned int accumulator_limit, int * opts, 
+  struct index_search_opt * opt) {
+    *opts = INDEX_SEARCH_NOOPT;
+    opt->u.okapi_k3.k1 = 1.2;
+    opt->u.okapi_k3.k3 = 1e10;
+    opt->u.okapi_k3.b = 0.75;
 
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "skk|sOk", kwlist, &query,
-          &startdoc, &len, &optType, &optArgsTuple, &accumulator_limit))
-        return NULL;
-    if ( (result = malloc(sizeof(*result) * len)) == NULL) {
-        PyErr_SetString(PyExc_MemoryError, "Unable to allocate results");
-        return NULL;
-    }
     if (optType != NULL) {
         if (strcmp(optType, "COSINE") == 0) {
-            opts = INDEX_SEARCH_COSINE_RANK;
+            *opts = INDEX_SEARCH_COSINE_RANK;
         } else if (strcmp(optType, "OKAPI") == 0) {
-            opts = INDEX_SEARCH_OKAPI_RANK;
+            *opts = INDEX_SEARCH_OKAPI_RANK;
         } else if (strcmp(optType, "OKAPI_K3") == 0) {
             if (optArgsTuple == NULL) {
                 PyErr_SetString(PyExc_StandardError, "Must supply args to "
                   "search type");
-                return NULL;
+                return 0;
             }
-            opts = INDEX_SEARCH_OKAPI_RANK;
-            if (!PyArg_ParseTuple(optArgsTuple, "ddd",
-                  &opt.u.okapi_k3.k1, &opt.u.okapi_k3.k3, &opt.u.okapi_k3.b)) {
-                return NULL;
+            *opts = INDEX_SEARCH_OKAPI_RANK;
+            if (!PyArg_ParseTuple(optArgsTuple, "ddd", &opt->u.okapi_k3.k1, 
+                  &opt->u.okapi_k3.k3, &opt->u.okapi_k3.b)) {
+                return 0;
             }
         } else if (strcmp(optType, "HAWKAPI") == 0) {
             if (optArgsTuple == NULL) {
                 PyErr_SetString(PyExc_StandardError, "Must supply args to "
                   "search type");
-                return NULL;
+                return 0;
             }
-            opts = INDEX_SEARCH_HAWKAPI_RANK;
-            if (!PyArg_ParseTuple(optArgsTuple, "dd", &opt.u.hawkapi.alpha,
-                  &opt.u.hawkapi.k3)) {
-                return NULL;
+            *opts = INDEX_SEARCH_HAWKAPI_RANK;
+            if (!PyArg_ParseTuple(optArgsTuple, "dd", &opt->u.hawkapi.alpha,
+                  &opt->u.hawkapi.k3)) {
+                return 0;
             }
         } else if (strcmp(optType, "DIRICHLET") == 0) {
-            opts = INDEX_SEARCH_DIRICHLET_RANK;
+            *opts = INDEX_SEARCH_DIRICHLET_RANK;
             if (optArgsTuple == NULL || PyTuple_Size(optArgsTuple) == 0) {
-                opt.u.dirichlet.mu = 2500.0;
+                opt->u.dirichlet.mu = 2500.0;
             } else if (!PyArg_ParseTuple(optArgsTuple, "f",
-                  &opt.u.dirichlet.mu)) {
-                return NULL;
+                  &opt->u.dirichlet.mu)) {
+                return 0;
             }
         } else {
             PyErr_SetString(PyExc_StandardError, "Unknown search type");
-            return NULL;
+            return 0;
         }
     }
     if (accumulator_limit != 0) {
-        opts |= INDEX_SEARCH_ACCUMULATOR_LIMIT;
-        opt.accumulator_limit = accumulator_limit;
+        *opts |= INDEX_SEARCH_ACCUMULATOR_LIMIT;
+        opt->accumulator_limit = accumulator_limit;
     }
-    if (!index_search(Index->idx, query, startdoc, len,
-          result, &results, &total_results, opts, &opt)) {
+    return 1;
+}
+
+/* run a single query, using result (of length len) as scratch space.
+ * Returns a new SearchResults object, or NULL with a Python exception set on
+ * failure. */
+static PyObject * search_to_PyObject(zet_IndexObject * Index, 
+  const char * query, unsigned long startdoc, unsigned long len, 
+  struct index_result * result, int opts, struct index_search_opt * opt) {
+    unsigned int results;
+    double total_results;
+    int est;
+    int ret;
+    int err;
+
+    INDEX_BEGIN(Index)
+    ret = index_search(Index->idx, query, startdoc, len,
+      result, &results, &total_results, &est, opts, opt);
+    err = errno;
+    INDEX_END(Index)
+    if (!ret) {
         char err_buf[1024];
         snprintf(err_buf, 1024, "Unable to perform search for query '%s'; "
-           "system error is '%s'\n", query, strerror(errno));
+           "system error is '%s'\n", query, strerror(err));
         PyErr_SetString(PyExc_StandardError, err_buf);
-        free(result);
         return NULL;
     }
-    pyResults = index_results_to_PyObject(result, results, total_results);
+    return index_results_to_PyObject(result, results, 
+      (unsigned long) total_results);
+}
+
+static PyObject * Index_search(PyObject * self, PyObject * args, 
+  PyObject * kwds) {
+    char * query;
+    char * optType = NULL;
+    PyObject * optArgsTuple = NULL;
+    unsigned long startdoc;
+    unsigned long len;
+    zet_IndexObject * Index = (zet_IndexObject *) self;
+    struct index_result * result;
+    unsigned int accumulator_limit = 0;
+    int opts;
+    struct index_search_opt opt;
+    static char * kwlist[] = {"query", "start_doc", "len", "opt_type",
+        "opt_args", "accumulator_limit", NULL};
+    PyObject * pyResults;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "skk|sOk", kwlist, &query,
+          &startdoc, &len, &optType, &optArgsTuple, &accumulator_limit))
+        return NULL;
+    if (!parse_search_opts(optType, optArgsTuple, accumulator_limit, &opts,
+          &opt))
+        return NULL;
+    if ( (result = malloc(sizeof(*result) * len)) == NULL) {
+        PyErr_SetString(PyExc_MemoryError, "Unable to allocate results");
+        return NULL;
+    }
+    pyResults = search_to_PyObject(Index, query, startdoc, len, result,
+      opts, &opt);
     free(result);
     return pyResults;
 }
 
+static PyObject * Index_search_many(PyObject * self, PyObject * args, 
+  PyObject * kwds) {
+    PyObject * queries;
+    PyObject * querySeq;
+    char * optType = NULL;
+    PyObject * optArgsTuple = NULL;
+    unsigned long startdoc;
+    unsigned long len;
+    zet_IndexObject * Index = (zet_IndexObject *) self;
+    struct index_result * result;
+    unsigned int accumulator_limit = 0;
+    int opts;
+    struct index_search_opt opt;
+    static char * kwlist[] = {"queries", "start_doc", "len", "opt_type",
+        "opt_args", "accumulator_limit", NULL};
+    PyObject * pyResultsList;
+    Py_ssize_t num_queries;
+    Py_ssize_t i;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "Okk|sOk", kwlist, &queries,
+          &startdoc, &len, &optType, &optArgsTuple, &accumulator_limit))
+        return NULL;
+    if (!parse_search_opts(optType, optArgsTuple, accumulator_limit, &opts,
+          &opt))
+        return NULL;
+    if ( (querySeq = PySequence_Fast(queries, 
+          "queries must be a sequence")) == NULL)
+        return NULL;
+    num_queries = PySequence_Fast_GET_SIZE(querySeq);
+    if ( (pyResultsList = PyList_New(num_queries)) == NULL) {
+        Py_DECREF(querySeq);
+        return NULL;
+    }
+    /* the result buffer is shared by all of the queries */
+    if ( (result = malloc(sizeof(*result) * len)) == NULL) {
+        PyErr_SetString(PyExc_MemoryError, "Unable to allocate results");
+        Py_DECREF(pyResultsList);
+        Py_DECREF(querySeq);
+        return NULL;
+    }
+    for (i = 0; i < num_queries; i++) {
+        PyObject * pyResults;
+        /* hold a reference to the query while the GIL is released, in case
+         * another thread removes it from the sequence */
+        PyObject * pyQuery = PySequence_Fast_GET_ITEM(querySeq, i);
+        char * query;
+
+        Py_INCREF(pyQuery);
+        query = PyString_AsString(pyQuery);
+        pyResults = NULL;
+        if (query != NULL) {
+            pyResults = search_to_PyObject(Index, query, startdoc, len, 
+              result, opts, &opt);
+        }
+        Py_DECREF(pyQuery);
+        if (pyResults == NULL) {
+            free(result);
+            Py_DECREF(pyResultsList);
+            Py_DECREF(querySeq);
+            return NULL;
+        }
+        PyList_SET_ITEM(pyResultsList, i, pyResults);
+    }
+    free(result);
+    Py_DECREF(querySeq);
+    return pyResultsList;
+}
+
 static PyObject * Index_retrieve(PyObject * self, PyObject * args, 
   PyObject * kwds) {
     unsigned long int docno;
@@ -1099,7 +1407,9 @@ static PyObject * Index_retrieve(PyObject * self, PyObject * args,
     if (len == 0) {
         unsigned int bytes;
 
+        INDEX_BEGIN(Index)
         bytes = index_retrieve_doc_bytes(Index->idx, docno);
+        INDEX_END(Index)
         if (bytes == UINT_MAX) {
             PyErr_SetString(PyExc_StandardError, 
               "Unable to retrieve doc stats");
@@ -1111,8 +1421,10 @@ static PyObject * Index_retrieve(PyObject * self, PyObject * args,
         PyErr_SetString(PyExc_MemoryError, "Out of memory");
         return NULL;
     }
+    INDEX_BEGIN(Index)
     retrieved_len = index_retrieve(Index->idx, docno, offset,
        dst, len);
+    INDEX_END(Index)
     if (retrieved_len == (unsigned int) -1) {
         PyErr_SetString(PyExc_StandardError, "Error retrieving document");
     } else {
@@ -1123,39 +1435,65 @@ static PyObject * Index_retrieve(PyObject * self, PyObject * args,
     return doc;
 }
 
+/* look up term in the Index's vocab, decoding its vocab entry into ve.
+ * The entry is copied out of the vocab while the Index's lock is held, as
+ * other threads can change the vocab's pages once it is released.  Returns
+ * 1 if the term was found, 0 if not, or -1 with a Python exception set. */
+static int Index_find_term(zet_IndexObject * Index, const char * term,
+  struct vocab_vector * ve) {
+    void * term_data;
+    unsigned int veclen;
+    char * copy = NULL;
+    struct vec vec;
+    int ret;
+
+    INDEX_BEGIN(Index)
+    term_data = iobtree_find(Index->idx->vocab, term, strlen(term), 0, 
+      &veclen);
+    if (term_data != NULL && (copy = malloc(veclen)) != NULL)
+        memcpy(copy, term_data, veclen);
+    INDEX_END(Index)
+    if (term_data == NULL)
+        return 0;
+    if (copy == NULL) {
+        PyErr_SetString(PyExc_MemoryError, 
+          "Out of memory copying vocab entry");
+        return -1;
+    }
+    vec.pos = copy;
+    vec.end = copy + veclen;
+    ret = vocab_decode(ve, &vec);
+    free(copy);
+    if (ret != VOCAB_OK) {
+        PyErr_SetString(PyExc_StandardError, "Error decoding vocab entry");
+        return -1;
+    }
+    /* XXX handle other types of vocab vector */
+    if (ve->type != VOCAB_VTYPE_DOCWP) {
+        PyErr_SetString(PyExc_StandardError, "Expected first vocab vector "
+          "entry to be doc-ordered with word positions, but this was not "
+          "the case");
+        return -1;
+    }
+    return 1;
+}
+
 /* XXX should return the VocabEntry object defined above for the
  * vocab iterator */
 static PyObject * Index_term_info(PyObject * self, PyObject * args) {
     zet_IndexObject * Index = (zet_IndexObject *) self;
-    struct iobtree * vocab = Index->idx->vocab;
     char * term;
-    unsigned int termlen;
-    void * term_data;
-    unsigned int veclen;
     struct vocab_vector ve;
-    struct vec vec;
+    int found;
 
     if (!PyArg_ParseTuple(args, "s", &term))
         return NULL;
-    termlen = strlen(term);
-    term_data = iobtree_find(vocab, term, termlen, 0, &veclen);
-    if (term_data == NULL) {
+    if ( (found = Index_find_term(Index, term, &ve)) <= 0) {
+        if (found < 0)
+            return NULL;
         Py_INCREF(Py_None);
         return Py_None;
     }
-    vec.pos = term_data;
-    vec.end = term_data + veclen;
-    if (vocab_decode(&ve, &vec) != VOCAB_OK) {
-        PyErr_SetString(PyExc_StandardError, "Error decoding vocab vector");
-        return NULL;
-    }
-    /* XXX handle other types of vocab vector */
-    if (ve.type != VOCAB_VTYPE_DOCWP) {
-        PyErr_SetString(PyExc_StandardError, "Expected first vocab vector "
-          "entry to be doc-ordered with word positions, but this was not "
-          "the case");
-        return NULL;
-    }
     return Py_BuildValue("(kkkk)", ve.header.docwp.docs, 
       ve.header.docwp.occurs, ve.header.docwp.last, ve.size);
 }
@@ -1163,38 +1501,21 @@ static PyObject * Index_term_info(PyObject * self, PyObject * args) {
 static PyObject * Index_term_postings(PyObject * self, PyObject * args) {
     zet_IndexObject * Index = (zet_IndexObject *) self;
     struct index * idx = Index->idx;
-    struct iobtree * vocab = idx->vocab;
     char * term;
-    unsigned int termlen;
     struct vocab_vector ve;
-    struct vec vec;
-    void * term_data;
-    unsigned int veclen;
+    int found;
     int fd;
+    ssize_t read_len = -1;
     zet_PostingsObject * postings;
 
-    /* FIXME copy of above */
     if (!PyArg_ParseTuple(args, "s", &term))
         return NULL;
-    termlen = strlen(term);
-    term_data = iobtree_find(vocab, term, termlen, 0, &veclen);
-    if (term_data == NULL) {
+    if ( (found = Index_find_term(Index, term, &ve)) <= 0) {
+        if (found < 0)
+            return NULL;
         Py_INCREF(Py_None);
         return Py_None;
     }
-    vec.pos = term_data;
-    vec.end = term_data + veclen;
-    if (vocab_decode(&ve, &vec) != VOCAB_OK) {
-        PyErr_SetString(PyExc_StandardError, "Error decoding vocab entry");
-        return NULL;
-    }
-    /* XXX handle other types of vocab vector */
-    if (ve.type != VOCAB_VTYPE_DOCWP) {
-        PyErr_SetString(PyExc_StandardError, "Expected first vocab vector "
-          "entry to be doc-ordered with word positions, but this was not "
-          "the case");
-        return NULL;
-    }
     if (ve.location != VOCAB_LOCATION_FILE) {
         PyErr_SetString(PyExc_StandardError, 
           "I only handle on-file vectors");
@@ -1211,21 +1532,28 @@ static PyObject * Index_term_postings(PyObject * self, PyObject * args) {
     postings->size = ve.size;
     postings->docs = ve.header.docwp.docs;
     postings->last = ve.header.docwp.last;
+    postings->skips = NULL;
+    postings->nskips = 0;
     if ( (postings->vec = malloc(ve.size)) == NULL) {
         PyErr_SetString(PyExc_MemoryError, 
           "Out of memory allocating vector buffer");
         PyObject_Del(postings);
         return NULL;
     }
+    INDEX_BEGIN(Index)
     fd = fdset_pin(idx->fd, idx->index_type, ve.loc.file.fileno, 
       ve.loc.file.offset, SEEK_SET);
-    if (fd == -1 || read(fd, postings->vec, ve.size) < ve.size) {
+    if (fd != -1) {
+        read_len = read(fd, postings->vec, ve.size);
+        fdset_unpin(idx->fd, idx->index_type, ve.loc.file.fileno, fd);
+    }
+    INDEX_END(Index)
+    if (read_len < (ssize_t) ve.size) {
         PyErr_SetString(PyExc_IOError, "Unable to read from vector file");
         free(postings->vec);
         PyObject_Del(postings);
         return NULL;
     }
-    fdset_unpin(idx->fd, idx->index_type, ve.loc.file.fileno, fd);
     return (PyObject *) postings;
 }
 
@@ -1252,7 +1580,9 @@ static PyObject * Index_num_docs(PyObject * self, PyObject * args) {
     struct index * idx = Index->idx;
     unsigned long num_docs;
 
-    num_docs = ndocmap_entries(idx->map);
+    INDEX_BEGIN(Index)
+    num_docs = docmap_entries(idx->map);
+    INDEX_END(Index)
     return Py_BuildValue("k", num_docs);
 }
 
@@ -1261,7 +1591,9 @@ static PyObject * Index_vocab_size(PyObject * self, PyObject * args) {
     struct index * idx = Index->idx;
     unsigned long vocab_size;
 
+    INDEX_BEGIN(Index)
     vocab_size = iobtree_size(idx->vocab);
+    INDEX_END(Index)
     return Py_BuildValue("k", vocab_size);
 }
 
@@ -1270,17 +1602,19 @@ static PyObject * Index_vocab_size(PyObject * self, PyObject * args) {
 static PyObject * Index_doc_aux(PyObject * self, PyObject * args) {
     zet_IndexObject * Index = (zet_IndexObject *) self;
     struct index * idx = Index->idx;
-    struct ndocmap * docmap = idx->map;
+    struct docmap * docmap = idx->map;
     char aux_buf[AUX_BUF_LEN];
     unsigned aux_len;
     unsigned long int docno;
-    enum ndocmap_ret ret;
+    enum docmap_ret ret;
 
     if (!PyArg_ParseTuple(args, "k", &docno))
         return NULL;
-    ret = ndocmap_get_aux(docmap, docno, aux_buf, AUX_BUF_LEN, &aux_len);
-    if (ret != NDOCMAP_OK) {
-        /* error might be NDOCMAP_BUFSIZE_ERROR, but life is too short... */
+    INDEX_BEGIN(Index)
+    ret = docmap_get_trecno(docmap, docno, aux_buf, AUX_BUF_LEN, &aux_len);
+    INDEX_END(Index)
+    if (ret != DOCMAP_OK) {
+        /* error might be DOCMAP_BUFSIZE_ERROR, but life is too short... */
         PyErr_SetString(PyExc_IOError, "Unable to read aux info");
         return NULL;
     }
@@ -1330,23 +1664,20 @@ static PyObject * index_result_to_PyObject(struct index_result * result) {
 static PyObject * index_results_to_PyObject(struct index_result * results,
   unsigned int num_results, unsigned long int total_results) {
     int i;
-    zet_SearchResultsObject * pyResult = PyObject_New(zet_SearchResultsObject,
-      &zet_SearchResultsType);
+    /* allocate through the type rather than PyObject_New, so that 
+     * subclasses get their instance dict etc. set up; the object comes back
+     * zeroed, so it can be DECREF'd from here on */
+    zet_SearchResultsObject * pyResult = (zet_SearchResultsObject *)
+        search_results_type->tp_alloc(search_results_type, 0);
     if (pyResult == NULL)
         return NULL;
-    if (PyObject_Init((PyObject *) pyResult, 
-          &zet_SearchResultsType) == NULL) {
-        PyObject_Del(pyResult); /* not DECREF, as not fully initialised */
-        return NULL;
-    }
     PyObject * results_tuple = PyTuple_New(num_results);
     if (results_tuple == NULL) {
-        PyObject_Del(pyResult); /* not DECREF, as not fully initialised */
+        Py_DECREF(pyResult);
         return NULL;
     }
     pyResult->results = results_tuple;
     pyResult->total_results = total_results;
-    /* from here, pyResult is fully initialised */
     for (i = 0; i < num_results; i++) {
         PyObject * result_tuple = index_result_to_PyObject(&results[i]);
         if (result_tuple == NULL) {
@@ -1371,6 +1702,7 @@ static PyObject * zet_search(PyObject *self, PyObject *args);
 static PyObject * zet_extract_words(PyObject *self, PyObject *args);
 static PyObject * zet_unpickle_search_result(PyObject * self, PyObject * args);
 static PyObject * zet_hash(PyObject * self, PyObject * args);
+static PyObject * zet_set_result_type(PyObject * self, PyObject * args);
 
 /*
  *  Methods as visible from Python.
@@ -1383,6 +1715,8 @@ static PyMethodDef ZetMethods[] = {
         "Constructor called when unpickling search results"},
     {"hash", zet_hash, METH_VARARGS, 
         "Hash a string according to the zettair's hash algorithm"},
+    {"set_result_type", zet_set_result_type, METH_VARARGS,
+        "Set the SearchResults subclass that searches return"},
     { NULL, NULL, 0, NULL }
 };
 
@@ -1398,9 +1732,11 @@ zet_search(PyObject *self, PyObject *args) {
     struct index * idx;
     struct index_result * result;
     unsigned int results;
-    unsigned long int total_results;
+    double total_results;
+    int est;
     int opts = INDEX_SEARCH_NOOPT;
     struct index_search_opt opt;
+    int ret;
 
     if (!PyArg_ParseTuple(args, "sskk", &prefix, &query, &startdoc,
           &len))
@@ -1415,15 +1751,19 @@ zet_search(PyObject *self, PyObject *args) {
         index_delete(idx);
         return NULL;
     }
-    if (!index_search(idx, query, startdoc, len, result, 
-          &results, &total_results, opts, &opt)) {
+    /* idx is private to this call, so only the GIL needs releasing */
+    Py_BEGIN_ALLOW_THREADS
+    ret = index_search(idx, query, startdoc, len, result, 
+      &results, &total_results, &est, opts, &opt);
+    Py_END_ALLOW_THREADS
+    if (!ret) {
         PyErr_SetString(PyExc_StandardError, "Unable to perform search");
         free(result);
         index_delete(idx);
         return NULL;
     }
     PyObject * results_tuple = index_results_to_PyObject(result, results,
-      total_results);
+      (unsigned long) total_results);
     free(result);
     index_delete(idx);
     return results_tuple;
@@ -1522,6 +1862,23 @@ zet_hash(PyObject *self, PyObject *args) {
     return Py_BuildValue("i", hval);
 }
 
+static PyObject * zet_set_result_type(PyObject * self, PyObject * args) {
+    PyTypeObject * type;
+
+    if (!PyArg_ParseTuple(args, "O!", &PyType_Type, &type))
+        return NULL;
+    if (!PyType_IsSubtype(type, &zet_SearchResultsType)) {
+        PyErr_SetString(PyExc_TypeError, 
+          "Result type must be a subclass of SearchResults");
+        return NULL;
+    }
+    Py_INCREF(type);
+    Py_DECREF(search_results_type);
+    search_results_type = type;
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
 /*
  *  Module initialization.
  */
@@ -1589,6 +1946,8 @@ PyMODINIT_FUNC initzet(void) {
     /* Adding SearchResults type to module */
     Py_INCREF(&zet_SearchResultsType);
     PyModule_AddObject(m, "SearchResults", (PyObject *) &zet_SearchResultsType);
+    /* ... and holding a reference for search_results_type */
+    Py_INCREF(&zet_SearchResultsType);
 
     /* Adding Posting type to module */
     Py_INCREF(&zet_PostingType);